@@ -0,0 +1,410 @@
+"""
+Benchmarks of the equivalent-source kernels and estimators.
+
+Run from this folder with ``python benchmarks.py`` (see ``--help``). Each case
+runs in a fresh process so that the peak memory (RSS) is its own. Results can
+be saved to a JSON file and compared against a previous run to flag
+regressions.
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import choclo
+import numpy as np
+import numba
+import verde as vd
+
+import eqs_magnetics as eqs
+import synthetics
+
+
+DATASETS = {
+    "simple": dict(
+        region=[-10e3, 10e3, -10e3, 10e3],
+        height=500,
+        depth=1e3,
+        field_direction=(84, 40),
+    ),
+    "complicated": dict(
+        region=[250e3, 450e3, -8550e3, -8250e3],
+        height=3e3,
+        depth=5e3,
+        field_direction=(84, 122),
+    ),
+}
+# Cases with fewer than this many dipoles use all data points as dipoles
+MAX_DIPOLES = 5000
+
+
+def make_dataset(name, size):
+    """
+    Total-field anomaly of one of the synthetic models on scattered points
+    """
+    config = DATASETS[name]
+    if name == "simple":
+        direction = [70, 60]
+        sources, moments = synthetics.simple_synthetic(
+            dyke1=direction, dyke2=direction, point1=direction, point2=direction,
+            point3=direction, point4=direction, regional=direction,
+        )
+    else:
+        sources, moments = synthetics.complicated_synthetic(
+            largest_anomaly=[65, 75], grid_anomaly=[68, 80],
+            scatter_anomaly=[40, 45], north_anomaly=[35, 70],
+            south_anomaly=[40, 45], regional=[-88, 78],
+        )
+    coordinates = vd.scatter_points(
+        config["region"], size, random_state=0, extra_coords=config["height"],
+    )
+    field_direction = eqs.angles_to_vector(*config["field_direction"], 1)
+    # The values don't change the run times so approximate the field to
+    # create large datasets quickly.
+    tfa = eqs.total_field_anomaly(
+        eqs.dipole_magnetic(coordinates, sources, moments, tolerance=0.3),
+        field_direction,
+    )
+    return dict(
+        coordinates=coordinates, data=tfa, field_direction=field_direction,
+        sources=sources, moments=moments, depth=config["depth"],
+    )
+
+
+def _subset(npoints, size):
+    """
+    Slice with a regularly spaced subset of at most *size* of the points
+    """
+    return slice(None, None, max(1, int(np.ceil(npoints / size))))
+
+
+def _take(arrays, subset):
+    """
+    Contiguous copies of a subset of the arrays (so Numba doesn't compile
+    again for strided arrays)
+    """
+    return tuple(np.ascontiguousarray(array[subset]) for array in arrays)
+
+
+def _dipoles(dataset):
+    """
+    Equivalent-source dipoles below (a subset of) the data points
+    """
+    subset = _subset(dataset["data"].size, MAX_DIPOLES)
+    easting, northing, upward = _take(dataset["coordinates"], subset)
+    return easting, northing, upward - dataset["depth"]
+
+
+class JacobianCase():
+
+    name = "jacobian"
+    unit = "pairs/s"
+
+    def setup(self, dataset):
+        estimator = eqs.EquivalentSourcesMagnetic(depth=dataset["depth"])
+        dipoles = _dipoles(dataset)
+        direction = eqs.angles_to_vector(90, 0, 1)
+        return estimator, (dataset["coordinates"], dipoles, direction, dataset["field_direction"])
+
+    def run(self, state):
+        estimator, arguments = state
+        estimator.jacobian(*arguments)
+
+    def work(self, dataset):
+        return dataset["coordinates"][0].size * min(MAX_DIPOLES, dataset["coordinates"][0].size)
+
+    def memory(self, size):
+        return 8 * size * min(MAX_DIPOLES, size)
+
+
+@numba.jit(nopython=True, parallel=True)
+def _jacobian_choclo(
+    easting, northing, upward, d_easting, d_northing, d_upward, m_easting,
+    m_northing, m_upward, f_easting, f_northing, f_upward, jacobian,
+):
+    """
+    Jacobian from the 3 components of the dipole field projected on the
+    field direction (the kernel used before _tfa_kernel)
+    """
+    for i in numba.prange(easting.size):
+        for j in range(d_easting.size):
+            b_easting, b_northing, b_upward = choclo.dipole.magnetic_field(
+                easting_p=easting[i],
+                northing_p=northing[i],
+                upward_p=upward[i],
+                easting_q=d_easting[j],
+                northing_q=d_northing[j],
+                upward_q=d_upward[j],
+                magnetic_moment_east=m_easting,
+                magnetic_moment_north=m_northing,
+                magnetic_moment_up=m_upward,
+            )
+            jacobian[i, j] = eqs.TESLA_TO_NANOTESLA * (
+                b_easting * f_easting
+                + b_northing * f_northing
+                + b_upward * f_upward
+            )
+
+
+class ChocloJacobianCase(JacobianCase):
+    """
+    Same as the jacobian case with the old kernel, to measure the speed-up of
+    _tfa_kernel. Checks that both Jacobians agree on the first rows.
+    """
+
+    name = "jacobian_choclo"
+
+    def setup(self, dataset):
+        estimator, arguments = super().setup(dataset)
+        coordinates, dipoles, direction, field_direction = arguments
+        rows = _take(coordinates, slice(None, 100))
+        reference = self.run((estimator, (rows, dipoles, direction, field_direction)))
+        np.testing.assert_allclose(
+            reference,
+            estimator.jacobian(rows, dipoles, direction, field_direction),
+            rtol=1e-10, atol=1e-10 * np.abs(reference).max(),
+        )
+        return estimator, arguments
+
+    def run(self, state):
+        estimator, (coordinates, dipoles, direction, field_direction) = state
+        jacobian = np.empty((coordinates[0].size, dipoles[0].size))
+        _jacobian_choclo(
+            *coordinates, *dipoles, *(np.ravel(c)[0] for c in direction),
+            *(np.ravel(c)[0] for c in field_direction), jacobian,
+        )
+        return jacobian
+
+
+class ForwardCase():
+
+    name = "forward"
+    unit = "pairs/s"
+
+    def setup(self, dataset):
+        return dataset
+
+    def run(self, dataset):
+        eqs.dipole_magnetic(dataset["coordinates"], dataset["sources"], dataset["moments"])
+
+    def work(self, dataset):
+        return dataset["coordinates"][0].size * dataset["sources"][0].size
+
+    def memory(self, size):
+        return 3 * 8 * size
+
+
+class FitCase():
+
+    name = "fit"
+    unit = "pairs/s"
+
+    def setup(self, dataset):
+        return dataset
+
+    def run(self, dataset):
+        eqs.EquivalentSourcesMagnetic(damping=1, depth=dataset["depth"]).fit(
+            dataset["coordinates"], dataset["data"], dataset["field_direction"],
+        )
+
+    def work(self, dataset):
+        return dataset["coordinates"][0].size**2
+
+    def memory(self, size):
+        # The Jacobian, its scaled copy, and the normal equations
+        return 3 * 8 * size**2
+
+
+class PredictCase():
+
+    name = "predict"
+    unit = "pairs/s"
+
+    def setup(self, dataset):
+        subset = _subset(dataset["data"].size, MAX_DIPOLES)
+        estimator = eqs.EquivalentSourcesMagnetic(damping=1, depth=dataset["depth"])
+        estimator.fit(
+            _take(dataset["coordinates"], subset), dataset["data"][subset],
+            dataset["field_direction"],
+        )
+        return estimator, dataset["coordinates"]
+
+    def run(self, state):
+        estimator, coordinates = state
+        estimator.predict(coordinates)
+
+    def work(self, dataset):
+        return dataset["coordinates"][0].size * min(MAX_DIPOLES, dataset["coordinates"][0].size)
+
+    def memory(self, size):
+        return 3 * 8 * MAX_DIPOLES**2 + 3 * 8 * size
+
+
+class GradientBoostingFitCase():
+
+    name = "gb_fit"
+    unit = "data/s"
+
+    def setup(self, dataset):
+        return dataset
+
+    def run(self, dataset):
+        eqs.EquivalentSourcesMagneticGB(
+            damping=1, depth=dataset["depth"], random_state=0,
+            influence_radius=2 * dataset["depth"],
+        ).fit(dataset["coordinates"], dataset["data"], dataset["field_direction"])
+
+    def work(self, dataset):
+        return dataset["coordinates"][0].size
+
+    def memory(self, size):
+        # Windows have around 5000 data and dipoles (see plan_windows)
+        return 3 * 8 * min(size, 5000)**2
+
+
+CASES = {
+    case.name: case
+    for case in (
+        JacobianCase(), ChocloJacobianCase(), ForwardCase(), FitCase(), PredictCase(),
+        GradientBoostingFitCase(),
+    )
+}
+
+
+def _run_case(case_name, dataset, threads, repeat):
+    """
+    Time a case in the current process (meant to be a fresh worker)
+    """
+    numba.set_num_threads(threads)
+    case = CASES[case_name]
+    # Compile the Numba functions on a small dataset first
+    subset = _subset(dataset["data"].size, 100)
+    small = dict(dataset)
+    small["coordinates"] = _take(dataset["coordinates"], subset)
+    small["data"] = dataset["data"][subset]
+    case.run(case.setup(small))
+    state = case.setup(dataset)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run(state)
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        "time": best,
+        "throughput": case.work(dataset) / best,
+        "unit": case.unit,
+        # Linux reports the maximum resident set size in kilobytes
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_benchmarks(cases, datasets, sizes, threads, repeat=3, max_memory=2e9):
+    """
+    Run all combinations of cases, datasets, sizes, and thread counts.
+
+    Cases that would need more than *max_memory* bytes are skipped. Returns a
+    list of results (one dict per run).
+    """
+    results = []
+    for dataset_name, size in itertools.product(datasets, sizes):
+        dataset = None
+        for case_name, nthreads in itertools.product(cases, threads):
+            case = CASES[case_name]
+            key = dict(case=case_name, dataset=dataset_name, size=size, threads=nthreads)
+            if case.memory(size) > max_memory:
+                print(f"skipped {_describe(key)} (needs {case.memory(size) / 1e9:.1f} GB)")
+                continue
+            if dataset is None:
+                dataset = make_dataset(dataset_name, size)
+            # Limit the BLAS threads of the worker as well
+            for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+                os.environ[variable] = str(nthreads)
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+            ) as pool:
+                result = pool.submit(_run_case, case_name, dataset, nthreads, repeat).result()
+            result = {**key, **result}
+            print(
+                f"{_describe(key)}: {result['time']:.3g} s, "
+                f"{result['throughput']:.3g} {result['unit']}, "
+                f"{result['peak_rss_mb']:.0f} MB"
+            )
+            results.append(result)
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Runs that are slower than in the baseline by more than the tolerance
+    """
+    reference = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        if _key(result) not in reference:
+            continue
+        old = reference[_key(result)]
+        if result["time"] > (1 + tolerance) * old["time"]:
+            regressions.append((result, old))
+    return regressions
+
+
+def _key(result):
+    return (result["case"], result["dataset"], result["size"], result["threads"])
+
+
+def _describe(key):
+    return f"{key['case']} {key['dataset']} n={key['size']} threads={key['threads']}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--datasets", nargs="+", choices=list(DATASETS), default=["simple"])
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, default=[1_000, 10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument(
+        "--threads", nargs="+", type=int,
+        default=sorted({1, numba.config.NUMBA_NUM_THREADS}),
+        help="Numba (and BLAS) thread counts to sweep.",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Best of this many runs.")
+    parser.add_argument(
+        "--max-memory", type=float, default=2e9,
+        help="Skip cases that need more bytes than this.",
+    )
+    parser.add_argument("--output", help="Save the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against the results in this JSON file.")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="Relative slowdown over the baseline flagged as a regression.",
+    )
+    args = parser.parse_args(argv)
+    results = run_benchmarks(
+        args.cases, args.datasets, args.sizes, args.threads, args.repeat, args.max_memory,
+    )
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as source:
+            baseline = json.load(source)
+        regressions = compare(results, baseline, args.tolerance)
+        for result, old in regressions:
+            print(
+                f"REGRESSION {_describe(result)}: "
+                f"{result['time']:.3g} s (baseline {old['time']:.3g} s)"
+            )
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
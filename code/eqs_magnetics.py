@@ -1,7 +1,25 @@
 """
 Module with custom functions for running magnetic equivalent sources.
 """
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import warnings
+
 import numpy as np
+import pandas as pd
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.spatial
+import sklearn.model_selection
 import sklearn.utils
 import sklearn.utils.validation
 import verde as vd
@@ -63,30 +81,60 @@ def angles_to_vector(inclination, declination, amplitude):
     return np.array([x, y, z])
 
 
-def dipole_magnetic(coordinates, dipoles, magnetic_moments):
+def dipole_magnetic(coordinates, dipoles, magnetic_moments, tolerance=None, dtype="float64"):
     """
     Magnetic field of a dipole (full 3-component vector).
     Output is in nanotesla.
+
+    If *tolerance* is given, the dipoles are grouped in a quadtree and groups
+    that are seen from the observation point under a ratio of size/distance
+    smaller than *tolerance* are replaced by a single equivalent dipole
+    (Barnes-Hut approximation). The size is scaled by the ratio of the sum of
+    the moment amplitudes to the amplitude of the summed moment so groups
+    whose moments cancel (e.g., fitted equivalent sources of alternating sign)
+    are opened more often. Smaller tolerances are more accurate and slower.
+    There is no error bound: the error depends on the moments and the
+    geometry. For example, predicting one fitted
+    :class:`EquivalentSourcesMagnetic` (damping=1, 3000 data) on a 100 m grid
+    had a maximum error of 0.2% of the largest field value with tolerance 0.3
+    and 0.5% with 0.5, but other fits have had errors above 1% with 0.5.
+    Compare against ``tolerance=None`` on a subset before relying on it.
+
+    Use ``dtype="float32"`` to halve the memory used by the output. The field
+    is still calculated and summed in double precision.
     """
     data_shape = coordinates[0].shape
     coordinates = [np.asarray(c).ravel() for c in coordinates]
     dipoles = [np.asarray(c).ravel() for c in dipoles]
     magnetic_moments = [np.asarray(c).ravel() for c in magnetic_moments]
-    magnetic_field = [np.zeros(coordinates[0].shape) for i in range(3)]
-    _dipole_magnetic_field_fast(
-        coordinates[0],
-        coordinates[1],
-        coordinates[2],
-        dipoles[0],
-        dipoles[1],
-        dipoles[2],
-        magnetic_moments[0],
-        magnetic_moments[1],
-        magnetic_moments[2],
-        magnetic_field[0],
-        magnetic_field[1],
-        magnetic_field[2],
-    )
+    magnetic_field = [np.zeros(coordinates[0].shape, dtype=dtype) for i in range(3)]
+    if tolerance is None:
+        _dipole_magnetic_field_fast(
+            coordinates[0],
+            coordinates[1],
+            coordinates[2],
+            dipoles[0],
+            dipoles[1],
+            dipoles[2],
+            magnetic_moments[0],
+            magnetic_moments[1],
+            magnetic_moments[2],
+            magnetic_field[0],
+            magnetic_field[1],
+            magnetic_field[2],
+        )
+    else:
+        tree = _build_dipole_tree(dipoles, magnetic_moments)
+        _dipole_magnetic_field_tree_fast(
+            coordinates[0],
+            coordinates[1],
+            coordinates[2],
+            *tree,
+            tolerance,
+            magnetic_field[0],
+            magnetic_field[1],
+            magnetic_field[2],
+        )
     return [TESLA_TO_NANOTESLA * m.reshape(data_shape) for m in magnetic_field]
 
 
@@ -99,6 +147,329 @@ def _dipole_magnetic_field_fast(
     This is the bit that runs the fast for-loops
     """
     for i in numba.prange(easting.size):
+        # Accumulate in double precision even if the output is single.
+        field_easting, field_northing, field_upward = 0.0, 0.0, 0.0
+        for j in range(d_easting.size):
+            field = choclo.dipole.magnetic_field(
+                easting_p=easting[i],
+                northing_p=northing[i],
+                upward_p=upward[i],
+                easting_q=d_easting[j],
+                northing_q=d_northing[j],
+                upward_q=d_upward[j],
+                magnetic_moment_east=m_easting[j],
+                magnetic_moment_north=m_northing[j],
+                magnetic_moment_up=m_upward[j],
+            )
+            field_easting += field[0]
+            field_northing += field[1]
+            field_upward += field[2]
+        b_easting[i] += field_easting
+        b_northing[i] += field_northing
+        b_upward[i] += field_upward
+
+
+def predict_layers(
+    estimators, coordinates, output="field", field_direction=None, tolerance=None,
+    dtype=None,
+):
+    """
+    Combined magnetic field of several fitted equivalent-source layers.
+
+    The dipoles of all layers are evaluated together in a single pass over
+    the observation points, which avoids computing and adding a separate
+    prediction for each layer. The total-field anomaly and the norm of the
+    field are accumulated directly for each point, without the intermediate
+    3-component arrays.
+
+    Parameters
+    ----------
+    estimators : list
+        Fitted :class:`EquivalentSourcesMagnetic` (or subclasses) instances.
+    coordinates : tuple of arrays
+        The easting, northing, and upward coordinates of the observations.
+    output : str
+        What to calculate: ``"field"`` for the 3 components of the magnetic
+        field, ``"tfa"`` for the total-field anomaly (requires
+        *field_direction*), or ``"norm"`` for the norm of the field.
+    field_direction : None or 2d-array
+        The unit vector of the main field (from :func:`angles_to_vector`).
+    tolerance : None or float
+        Use the Barnes-Hut approximation (see :func:`dipole_magnetic`).
+    dtype : None or str
+        Data type of the prediction. If None, float32 only if all layers use
+        ``dtype="float32"``.
+
+    Returns
+    -------
+    result : array or list of arrays
+        The 3 field components if ``output="field"``, otherwise a single
+        array. Same shape as the coordinates. In nanotesla.
+    """
+    dipole_coordinates, dipole_moments = _stack_layers(estimators)
+    return _magnetic_output(
+        coordinates, dipole_coordinates, dipole_moments, output, field_direction,
+        tolerance, _layers_dtype(estimators, dtype),
+    )
+
+
+def _layers_dtype(estimators, dtype=None):
+    """
+    The given dtype or the widest one of the estimators
+    """
+    if dtype is None:
+        return np.result_type(*(np.dtype(e.dtype) for e in estimators))
+    return np.dtype(dtype)
+
+
+def _stack_layers(estimators):
+    """
+    Concatenate the dipole coordinates and moments of fitted estimators
+    """
+    for estimator in estimators:
+        sklearn.utils.validation.check_is_fitted(estimator, ["dipole_moments_"])
+    dipole_coordinates = [
+        np.concatenate([np.ravel(e.dipole_coordinates_[i]) for e in estimators])
+        for i in range(3)
+    ]
+    dipole_moments = [
+        np.concatenate([np.ravel(e.dipole_moments_[i]) for e in estimators])
+        for i in range(3)
+    ]
+    return dipole_coordinates, dipole_moments
+
+
+def iter_predict_grid(
+    estimators, region, spacing=None, shape=None, height=0, tile_points=1_000_000,
+    output="field", field_direction=None, tolerance=None, dtype=None,
+):
+    """
+    Predict on a regular grid one tile of rows at a time.
+
+    Only the coordinates and predictions of the current tile are kept in
+    memory, so the peak memory depends on *tile_points* and not on the size
+    of the grid. See :func:`predict_grid` to store the tiles in an array or
+    file.
+
+    Parameters
+    ----------
+    estimators : estimator or list of estimators
+        The fitted equivalent sources. The fields of multiple estimators are
+        added (see :func:`predict_layers`).
+    region : list = [W, E, S, N]
+        The boundaries of the grid.
+    spacing, shape : float, tuple, or None
+        The grid spacing or shape (see :func:`verde.grid_coordinates`).
+    height : float
+        The upward coordinate of the grid.
+    tile_points : int
+        Approximate number of grid nodes in each tile. Tiles are made of whole
+        grid rows.
+    output, field_direction, tolerance, dtype
+        Passed to :func:`predict_layers`.
+
+    Yields
+    ------
+    rows : slice
+        The rows (northing indices) of the grid covered by the tile.
+    prediction : array or list of arrays
+        The prediction on the tile. Has shape ``(3, nrows, ncols)`` for
+        ``output="field"`` and ``(nrows, ncols)`` otherwise.
+    """
+    if not isinstance(estimators, (list, tuple)):
+        estimators = [estimators]
+    dtype = _layers_dtype(estimators, dtype)
+    dipole_coordinates, dipole_moments = _stack_layers(estimators)
+    easting, northing = vd.grid_coordinates(
+        region, spacing=spacing, shape=shape, meshgrid=False,
+    )
+    rows_per_tile = max(1, tile_points // easting.size)
+    for start in range(0, northing.size, rows_per_tile):
+        rows = slice(start, min(start + rows_per_tile, northing.size))
+        tile_easting, tile_northing = np.meshgrid(easting, northing[rows])
+        tile_coordinates = (
+            tile_easting, tile_northing, np.full_like(tile_easting, height),
+        )
+        prediction = _magnetic_output(
+            tile_coordinates, dipole_coordinates, dipole_moments, output,
+            field_direction, tolerance, dtype,
+        )
+        if output == "field":
+            prediction = np.asarray(prediction)
+        yield rows, prediction
+
+
+def predict_grid(
+    estimators, region, spacing=None, shape=None, height=0, tile_points=1_000_000,
+    output="field", field_direction=None, tolerance=None, out=None, dtype=None,
+):
+    """
+    Predict on a regular grid tile by tile and store the result in *out*.
+
+    *out* can be any array-like that supports slice assignment and has shape
+    ``(3, nrows, ncols)`` for ``output="field"`` or ``(nrows, ncols)``
+    otherwise: a :func:`numpy.lib.format.open_memmap` array, a netCDF4
+    variable, a Zarr array, etc. If None, a numpy array of type *dtype* is
+    allocated. See :func:`iter_predict_grid` for the other parameters.
+
+    Returns
+    -------
+    out : array-like
+        The array with the predicted grid.
+    """
+    if not isinstance(estimators, (list, tuple)):
+        estimators = [estimators]
+    dtype = _layers_dtype(estimators, dtype)
+    if out is None:
+        easting, northing = vd.grid_coordinates(
+            region, spacing=spacing, shape=shape, meshgrid=False,
+        )
+        if output == "field":
+            out = np.empty((3, northing.size, easting.size), dtype=dtype)
+        else:
+            out = np.empty((northing.size, easting.size), dtype=dtype)
+    for rows, prediction in iter_predict_grid(
+        estimators, region, spacing=spacing, shape=shape, height=height,
+        tile_points=tile_points, output=output, field_direction=field_direction,
+        tolerance=tolerance, dtype=dtype,
+    ):
+        out[..., rows, :] = prediction
+    return out
+
+
+def predict_grid_netcdf(
+    fname, estimators, region, spacing=None, shape=None, height=0,
+    tile_points=1_000_000, output="field", field_direction=None, tolerance=None,
+    dtype=None,
+):
+    """
+    Predict on a regular grid tile by tile straight into a NetCDF file.
+
+    The file has ``easting`` and ``northing`` dimensions and one variable per
+    output (``b_easting``, ``b_northing``, ``b_upward`` for the field or
+    ``tfa``/``norm``), chunked by tile. It can be opened lazily with
+    :func:`xarray.open_dataset`. Requires the netCDF4 package. See
+    :func:`iter_predict_grid` for the other parameters.
+    """
+    import netCDF4
+
+    if not isinstance(estimators, (list, tuple)):
+        estimators = [estimators]
+    dtype = _layers_dtype(estimators, dtype)
+    easting, northing = vd.grid_coordinates(
+        region, spacing=spacing, shape=shape, meshgrid=False,
+    )
+    rows_per_tile = min(max(1, tile_points // easting.size), northing.size)
+    if output == "field":
+        names = ["b_easting", "b_northing", "b_upward"]
+    else:
+        names = [output]
+    with netCDF4.Dataset(fname, "w") as dataset:
+        dataset.createDimension("northing", northing.size)
+        dataset.createDimension("easting", easting.size)
+        for name, values in [("northing", northing), ("easting", easting)]:
+            variable = dataset.createVariable(name, "f8", (name,))
+            variable[:] = values
+        dataset.createVariable("upward", "f8", ())[...] = height
+        variables = [
+            dataset.createVariable(
+                name, dtype, ("northing", "easting"),
+                chunksizes=(rows_per_tile, easting.size),
+            )
+            for name in names
+        ]
+        for variable in variables:
+            variable.units = "nT"
+        for rows, prediction in iter_predict_grid(
+            estimators, region, spacing=spacing, shape=shape, height=height,
+            tile_points=tile_points, output=output,
+            field_direction=field_direction, tolerance=tolerance, dtype=dtype,
+        ):
+            if output != "field":
+                prediction = [prediction]
+            for variable, values in zip(variables, prediction):
+                variable[rows, :] = values
+    return fname
+
+
+def _magnetic_output(
+    coordinates, dipoles, magnetic_moments, output, field_direction, tolerance,
+    dtype="float64",
+):
+    """
+    Dispatch to the kernel that calculates the requested output directly
+    """
+    if output == "field" or tolerance is not None:
+        magnetic_field = dipole_magnetic(
+            coordinates, dipoles, magnetic_moments, tolerance=tolerance, dtype=dtype,
+        )
+        if output == "field":
+            return magnetic_field
+    if output == "tfa" and field_direction is None:
+        raise ValueError("A 'field_direction' is required for output='tfa'.")
+    if output == "tfa":
+        if tolerance is not None:
+            return total_field_anomaly(magnetic_field, field_direction).astype(dtype, copy=False)
+        kernel = _dipole_magnetic_tfa_fast
+        direction = tuple(np.ravel(c)[0] for c in field_direction)
+    elif output == "norm":
+        if tolerance is not None:
+            return magnetic_field_norm(magnetic_field).astype(dtype, copy=False)
+        kernel = _dipole_magnetic_norm_fast
+        direction = ()
+    else:
+        raise ValueError(
+            f"Invalid output '{output}'. Must be 'field', 'tfa', or 'norm'."
+        )
+    data_shape = np.shape(coordinates[0])
+    coordinates = [np.asarray(c).ravel() for c in coordinates]
+    dipoles = [np.asarray(c).ravel() for c in dipoles]
+    magnetic_moments = [np.asarray(c).ravel() for c in magnetic_moments]
+    result = np.empty(coordinates[0].size, dtype=dtype)
+    kernel(*coordinates, *dipoles, *magnetic_moments, *direction, result)
+    return result.reshape(data_shape)
+
+
+@numba.jit(nopython=True, parallel=True)
+def _dipole_magnetic_tfa_fast(
+    easting, northing, upward, d_easting, d_northing, d_upward, m_easting,
+    m_northing, m_upward, f_easting, f_northing, f_upward, result,
+):
+    """
+    Total-field anomaly accumulated directly for each point (in nT)
+    """
+    for i in numba.prange(easting.size):
+        b_easting, b_northing, b_upward = 0.0, 0.0, 0.0
+        for j in range(d_easting.size):
+            field = choclo.dipole.magnetic_field(
+                easting_p=easting[i],
+                northing_p=northing[i],
+                upward_p=upward[i],
+                easting_q=d_easting[j],
+                northing_q=d_northing[j],
+                upward_q=d_upward[j],
+                magnetic_moment_east=m_easting[j],
+                magnetic_moment_north=m_northing[j],
+                magnetic_moment_up=m_upward[j],
+            )
+            b_easting += field[0]
+            b_northing += field[1]
+            b_upward += field[2]
+        result[i] = TESLA_TO_NANOTESLA * (
+            b_easting * f_easting + b_northing * f_northing + b_upward * f_upward
+        )
+
+
+@numba.jit(nopython=True, parallel=True)
+def _dipole_magnetic_norm_fast(
+    easting, northing, upward, d_easting, d_northing, d_upward, m_easting,
+    m_northing, m_upward, result,
+):
+    """
+    Norm of the magnetic field accumulated directly for each point (in nT)
+    """
+    for i in numba.prange(easting.size):
+        b_easting, b_northing, b_upward = 0.0, 0.0, 0.0
         for j in range(d_easting.size):
             field = choclo.dipole.magnetic_field(
                 easting_p=easting[i],
@@ -111,9 +482,178 @@ def _dipole_magnetic_field_fast(
                 magnetic_moment_north=m_northing[j],
                 magnetic_moment_up=m_upward[j],
             )
-            b_easting[i] += field[0]
-            b_northing[i] += field[1]
-            b_upward[i] += field[2]
+            b_easting += field[0]
+            b_northing += field[1]
+            b_upward += field[2]
+        result[i] = TESLA_TO_NANOTESLA * np.sqrt(
+            b_easting**2 + b_northing**2 + b_upward**2
+        )
+
+
+# Average number of dipoles in the leaves of the Barnes-Hut quadtree
+TREE_LEAF_SIZE = 16
+TREE_MAX_LEVELS = 11
+
+
+def _build_dipole_tree(dipoles, magnetic_moments):
+    """
+    Build a full quadtree of the dipoles for the Barnes-Hut approximation.
+
+    The tree is stored as a pyramid of regular grids (one per level) in flat
+    arrays. Each cell has the total moment of its dipoles located at their
+    moment-weighted centre and a size (the largest of its width and vertical
+    extent). The dipoles are sorted by leaf cell so that each leaf indexes a
+    contiguous slice.
+    """
+    easting, northing, upward = dipoles
+    size = easting.size
+    levels = int(np.ceil(np.log(max(size / TREE_LEAF_SIZE, 1)) / np.log(4)))
+    levels = min(levels, TREE_MAX_LEVELS)
+    west, south = easting.min(), northing.min()
+    width = max(easting.max() - west, northing.max() - south, 1.0)
+    ncells = 2**levels
+    column = np.clip(((easting - west) / width * ncells).astype(int), 0, ncells - 1)
+    row = np.clip(((northing - south) / width * ncells).astype(int), 0, ncells - 1)
+    leaf = row * ncells + column
+    order = np.argsort(leaf, kind="stable")
+    leaf_offsets = np.zeros(ncells**2 + 1, dtype=np.int64)
+    leaf_offsets[1:] = np.cumsum(np.bincount(leaf, minlength=ncells**2))
+    amplitude = np.sqrt(sum(m**2 for m in magnetic_moments))
+    # Aggregate the leaves and then sum 2x2 blocks of children to go up.
+    leaf_sums = [
+        np.bincount(leaf, weights=w, minlength=ncells**2).reshape(ncells, ncells)
+        for w in (
+            np.ones(size), amplitude, *magnetic_moments,
+            amplitude * easting, amplitude * northing, amplitude * upward,
+        )
+    ]
+    top = np.full(ncells**2, -np.inf)
+    bottom = np.full(ncells**2, np.inf)
+    np.maximum.at(top, leaf, upward)
+    np.minimum.at(bottom, leaf, upward)
+    pyramid = [leaf_sums + [top.reshape(ncells, ncells), bottom.reshape(ncells, ncells)]]
+    for level in range(levels - 1, -1, -1):
+        children = [a.reshape(2**level, 2, 2**level, 2) for a in pyramid[0]]
+        parents = [a.sum(axis=(1, 3)) for a in children[:-2]]
+        parents.append(children[-2].max(axis=(1, 3)))
+        parents.append(children[-1].min(axis=(1, 3)))
+        pyramid.insert(0, parents)
+    flat = [np.concatenate([cell[k].ravel() for cell in pyramid]) for k in range(10)]
+    count, weight, m_easting, m_northing, m_upward = flat[:5]
+    # Centre of cells without moment is irrelevant since they add no field
+    safe_weight = np.where(weight > 0, weight, 1)
+    c_easting = flat[5] / safe_weight
+    c_northing = flat[6] / safe_weight
+    c_upward = flat[7] / safe_weight
+    cell_width = width / 2.0 ** np.repeat(np.arange(levels + 1), 4 ** np.arange(levels + 1))
+    cell_size = np.where(count > 0, np.maximum(cell_width, flat[8] - flat[9]), 0)
+    # Moments of opposite directions cancel in the equivalent dipole but not
+    # in the error of replacing them with it. Make cells look larger by the
+    # ratio of the sum of the moment amplitudes to the amplitude of the sum.
+    net_moment = np.sqrt(m_easting**2 + m_northing**2 + m_upward**2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cell_size = np.where(
+            count > 0, cell_size * np.where(net_moment > 0, weight / net_moment, np.inf), 0,
+        )
+    return (
+        levels,
+        count,
+        c_easting,
+        c_northing,
+        c_upward,
+        m_easting,
+        m_northing,
+        m_upward,
+        cell_size,
+        leaf_offsets,
+        easting[order],
+        northing[order],
+        upward[order],
+        magnetic_moments[0][order],
+        magnetic_moments[1][order],
+        magnetic_moments[2][order],
+    )
+
+
+@numba.jit(nopython=True, parallel=True)
+def _dipole_magnetic_field_tree_fast(
+    easting, northing, upward, levels, count, c_easting, c_northing, c_upward,
+    cm_easting, cm_northing, cm_upward, cell_size, leaf_offsets, d_easting,
+    d_northing, d_upward, m_easting, m_northing, m_upward, tolerance,
+    b_easting, b_northing, b_upward,
+):
+    """
+    Traverse the quadtree for each point and sum the field of the cells that
+    are far enough or of the dipoles in the nearby leaves.
+    """
+    chunk_size = 256
+    nchunks = (easting.size + chunk_size - 1) // chunk_size
+    for chunk in numba.prange(nchunks):
+        # One stack per chunk of points to avoid allocating for every point.
+        # Each level adds at most 3 pending cells.
+        stack_level = np.empty(3 * levels + 4, dtype=np.int64)
+        stack_cell = np.empty(3 * levels + 4, dtype=np.int64)
+        for i in range(chunk * chunk_size, min((chunk + 1) * chunk_size, easting.size)):
+            stack_level[0] = 0
+            stack_cell[0] = 0
+            top = 1
+            field_easting, field_northing, field_upward = 0.0, 0.0, 0.0
+            while top > 0:
+                top -= 1
+                level = stack_level[top]
+                cell = stack_cell[top]
+                # Offset of this level in the flat arrays: (4**level - 1) / 3
+                index = (4**level - 1) // 3 + cell
+                if count[index] == 0:
+                    continue
+                distance = np.sqrt(
+                    (easting[i] - c_easting[index]) ** 2
+                    + (northing[i] - c_northing[index]) ** 2
+                    + (upward[i] - c_upward[index]) ** 2
+                )
+                if cell_size[index] < tolerance * distance:
+                    field = choclo.dipole.magnetic_field(
+                        easting_p=easting[i],
+                        northing_p=northing[i],
+                        upward_p=upward[i],
+                        easting_q=c_easting[index],
+                        northing_q=c_northing[index],
+                        upward_q=c_upward[index],
+                        magnetic_moment_east=cm_easting[index],
+                        magnetic_moment_north=cm_northing[index],
+                        magnetic_moment_up=cm_upward[index],
+                    )
+                    field_easting += field[0]
+                    field_northing += field[1]
+                    field_upward += field[2]
+                elif level == levels:
+                    for j in range(leaf_offsets[cell], leaf_offsets[cell + 1]):
+                        field = choclo.dipole.magnetic_field(
+                            easting_p=easting[i],
+                            northing_p=northing[i],
+                            upward_p=upward[i],
+                            easting_q=d_easting[j],
+                            northing_q=d_northing[j],
+                            upward_q=d_upward[j],
+                            magnetic_moment_east=m_easting[j],
+                            magnetic_moment_north=m_northing[j],
+                            magnetic_moment_up=m_upward[j],
+                        )
+                        field_easting += field[0]
+                        field_northing += field[1]
+                        field_upward += field[2]
+                else:
+                    ncells = 2**level
+                    row = cell // ncells
+                    column = cell % ncells
+                    for child_row in range(2 * row, 2 * row + 2):
+                        for child_column in range(2 * column, 2 * column + 2):
+                            stack_level[top] = level + 1
+                            stack_cell[top] = child_row * 2 * ncells + child_column
+                            top += 1
+            b_easting[i] += field_easting
+            b_northing[i] += field_northing
+            b_upward[i] += field_upward
 
 
 def total_field_anomaly(source_magnetic_field, main_field_direction):
@@ -141,17 +681,306 @@ def recommended_source_depth(coordinates):
     Estimates an approximate depth of sources based on their horizontal spacing
     From Dampney (1969).
     """
-    spacing = np.mean(vd.median_distance(coordinates))
+    spacing = np.mean(_as_geometry(coordinates).median_distance)
     # Dampney recommends between 2.5 and 6 x spacing. Take the average.
     depth = 4.25 * spacing
     return depth
 
 
+class PreparedGeometry():
+    """
+    Data coordinates with the geometry preprocessing of the fits cached.
+
+    Pass it instead of the coordinates to the ``fit`` methods of the
+    equivalent-source classes. Fitting the same coordinates several times
+    (e.g., for different dampings or windows) then builds the KD-tree,
+    finds the point spacing for the source depth, and block-reduces the dipole
+    layout only once.
+
+    Parameters
+    ----------
+    coordinates : tuple of arrays
+        Easting, northing, and upward coordinates of the data.
+
+    Attributes
+    ----------
+    coordinates : tuple of arrays
+        The coordinates as given.
+    coordinates_1d : tuple of 1d-arrays
+        The raveled easting, northing, and upward coordinates.
+    """
+
+    def __init__(self, coordinates):
+        self.coordinates = tuple(np.asarray(c) for c in coordinates)
+        self.coordinates_1d = tuple(vdb.n_1d_arrays(self.coordinates, 3))
+        self._region = None
+        self._tree = None
+        self._median_distance = None
+        self._block_reduced = {}
+
+    @property
+    def region(self):
+        """
+        The horizontal region of the coordinates
+        """
+        if self._region is None:
+            self._region = vd.get_region(self.coordinates_1d[:2])
+        return self._region
+
+    @property
+    def tree(self):
+        """
+        KD-tree of the horizontal coordinates
+        """
+        if self._tree is None:
+            self._tree = scipy.spatial.cKDTree(np.transpose(self.coordinates_1d[:2]))
+        return self._tree
+
+    @property
+    def median_distance(self):
+        """
+        Distance from each point to its nearest neighbour
+
+        Same as :func:`verde.median_distance` with one neighbour.
+        """
+        if self._median_distance is None:
+            distances = self.tree.query(np.transpose(self.coordinates_1d[:2]), k=2)[0]
+            self._median_distance = distances[:, 1]
+        return self._median_distance
+
+    def block_reduced(self, block_size):
+        """
+        Median of the coordinates in blocks of the given size
+        """
+        if block_size not in self._block_reduced:
+            reducer = vd.BlockReduce(
+                spacing=block_size, reduction="median", drop_coords=False
+            )
+            # Must pass a dummy data array to BlockReduce.filter(), we choose
+            # one of the coordinate arrays. We will ignore the returned reduced
+            # dummy array.
+            self._block_reduced[block_size] = tuple(
+                reducer.filter(self.coordinates_1d, self.coordinates_1d[0])[0]
+            )
+        return self._block_reduced[block_size]
+
+
+def load_equivalent_sources(directory, mmap_mode="r"):
+    """
+    Load a model saved with :meth:`EquivalentSourcesMagnetic.save`.
+
+    Parameters
+    ----------
+    directory : str
+        The directory with the saved model.
+    mmap_mode : None or str
+        Passed to :func:`numpy.load`. The default memory-maps the dipole
+        arrays read-only so loading is instant and processes loading the same
+        model share the memory. Use None to read them into memory.
+
+    Returns
+    -------
+    estimator : :class:`EquivalentSourcesMagnetic` or :class:`EquivalentSourcesMagneticGB`
+        The fitted estimator.
+    """
+    with open(os.path.join(directory, "metadata.json")) as source:
+        metadata = json.load(source)
+    if metadata["format_version"] != 1:
+        raise ValueError(f"Unsupported format version '{metadata['format_version']}'.")
+    classes = {
+        cls.__name__: cls
+        for cls in (EquivalentSourcesMagnetic, EquivalentSourcesMagneticGB)
+    }
+    if metadata["class"] not in classes:
+        raise ValueError(f"Unknown estimator class '{metadata['class']}'.")
+    estimator = classes[metadata["class"]](**metadata["parameters"])
+    for key, value in metadata["fitted"].items():
+        setattr(estimator, key, value)
+    for name in ("dipole_coordinates", "dipole_moments"):
+        setattr(
+            estimator, f"{name}_",
+            np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode),
+        )
+    return estimator
+
+
+def _to_json(value):
+    """
+    The value converted to JSON types. Data types are saved as strings (e.g.,
+    ``"<f4"``). Raises a TypeError if it can't be converted.
+    """
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.dtype) or (
+        isinstance(value, type) and issubclass(value, np.generic)
+    ):
+        return np.dtype(value).str
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f"Can't save a value of type '{type(value).__name__}'.")
+
+
+def _to_json_or_none(name, value):
+    """
+    The value converted to JSON types or None (with a warning) if it can't be
+    """
+    try:
+        return _to_json(value)
+    except TypeError:
+        warnings.warn(
+            f"Can't save '{name}' (a {type(value).__name__}). It will be None "
+            "when the model is loaded."
+        )
+        return None
+
+
+def _as_geometry(coordinates):
+    """
+    The coordinates as a PreparedGeometry (unless they already are one)
+    """
+    if isinstance(coordinates, PreparedGeometry):
+        return coordinates
+    return PreparedGeometry(coordinates)
+
+
+class JacobianCache():
+    """
+    Least-recently-used cache of Jacobian matrices keyed on their geometry.
+
+    Pass an instance as the ``jacobian_cache`` of the equivalent-source
+    estimators to skip building the Jacobian when the same data coordinates,
+    dipoles, and directions come up again (cross-validation, repeated
+    gradient-boosting windows, reprocessing). With the dense solver and a
+    damping, the Cholesky factorisation of the damped normal equations is
+    cached as well so refitting the same geometry to other data is cheap.
+    Workers of ``n_jobs`` start with empty caches (only the on-disk entries
+    are shared between them).
+
+    Entries are kept in memory until they add up to more than *max_bytes*.
+    Then the least recently used ones are evicted. If a *directory* is given,
+    evicted entries are saved there as ``.npy`` files and later loaded as
+    read-only memory-mapped arrays. The directory isn't cleaned up and can be
+    shared between processes and runs (only the configuration is pickled,
+    not the entries in memory).
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory budget for the in-memory entries.
+    directory : None or str
+        Directory for the on-disk tier. If None, evicted entries are dropped.
+    """
+
+    def __init__(self, max_bytes=2**30, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._entries = collections.OrderedDict()
+        self.nbytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes, "directory": self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(*arrays, **parameters):
+        """
+        Hash of the contents of the arrays and the values of the parameters
+        """
+        digest = hashlib.sha1()
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(repr((array.shape, array.dtype.str)).encode())
+            digest.update(array.data)
+        digest.update(repr(sorted(parameters.items())).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        The cached array (or tuple of arrays) or None if it's not cached
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self.directory is not None:
+            fnames = self._fnames(key)
+            if len(fnames) == 1 and fnames[0].endswith(f"{key}.npy"):
+                return np.load(fnames[0], mmap_mode="r")
+            if fnames:
+                return tuple(np.load(fname, mmap_mode="r") for fname in fnames)
+        return None
+
+    def put(self, key, value):
+        """
+        Store an array (or tuple of arrays) and evict old entries if needed
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = value
+        self.nbytes += _nbytes(value)
+        while self.nbytes > self.max_bytes and self._entries:
+            old_key, old_value = self._entries.popitem(last=False)
+            self.nbytes -= _nbytes(old_value)
+            if self.directory is not None and not self._fnames(old_key):
+                self._save(old_key, old_value)
+
+    def _fnames(self, key):
+        """
+        The files of a key in the on-disk tier (empty if not saved)
+        """
+        single = os.path.join(self.directory, f"{key}.npy")
+        if os.path.exists(single):
+            return [single]
+        fnames = []
+        while os.path.exists(os.path.join(self.directory, f"{key}-{len(fnames)}.npy")):
+            fnames.append(os.path.join(self.directory, f"{key}-{len(fnames)}.npy"))
+        return fnames
+
+    def _save(self, key, value):
+        """
+        Write an entry to the on-disk tier atomically
+        """
+        if isinstance(value, tuple):
+            names = [f"{key}-{i}.npy" for i in range(len(value))]
+            # Write the parts in reverse so that the entry is only found when
+            # all of them are there.
+            items = list(zip(names, value))[::-1]
+        else:
+            items = [(f"{key}.npy", value)]
+        for name, array in items:
+            temporary = os.path.join(self.directory, f".{name}.{os.getpid()}.tmp")
+            with open(temporary, "wb") as output:
+                np.save(output, np.asarray(array))
+            os.replace(temporary, os.path.join(self.directory, name))
+
+
+def _nbytes(value):
+    """
+    Memory used by an array or tuple of arrays
+    """
+    if isinstance(value, tuple):
+        return sum(np.asarray(v).nbytes for v in value)
+    return np.asarray(value).nbytes
+
+
 class EquivalentSourcesMagnetic():
 
     def __init__(
         self, damping=None, depth=None, block_size=None,
         dipole_inclination=90, dipole_declination=0, dipole_coordinates=None,
+        solver="dense", cutoff=None, dtype="float64", jacobian_cache=None,
+        callback=None,
     ):
         self.damping = damping
         self.depth = depth
@@ -159,50 +988,216 @@ class EquivalentSourcesMagnetic():
         self.dipole_coordinates = dipole_coordinates
         self.dipole_inclination = dipole_inclination
         self.dipole_declination = dipole_declination
+        self.solver = solver
+        self.cutoff = cutoff
+        self.dtype = dtype
+        self.jacobian_cache = jacobian_cache
+        self.callback = callback
 
     def fit(self, coordinates, data, field_direction, weights=None):
         """
         """
-        coordinates, data, weights = vdb.check_fit_input(coordinates, data, weights)
-        # Capture the data region to use as a default when gridding.
-        self.region_ = vd.get_region(coordinates[:2])
-        coordinates = vdb.n_1d_arrays(coordinates, 3)
-        self.dipole_coordinates_ = self._build_points(coordinates)
+        stopwatch = _Stopwatch()
+        with stopwatch("setup"):
+            geometry = _as_geometry(coordinates)
+            coordinates, data, weights = vdb.check_fit_input(geometry.coordinates, data, weights)
+            # Capture the data region to use as a default when gridding.
+            self.region_ = geometry.region
+            coordinates = geometry.coordinates_1d
+            self.depth_ = self._source_depth(geometry)
+            self.dipole_coordinates_ = self._build_points(geometry, self.depth_)
         dipole_moment_direction = angles_to_vector(
             self.dipole_inclination, self.dipole_declination, 1,
         )
-        jacobian = self.jacobian(
-            coordinates, self.dipole_coordinates_, dipole_moment_direction, field_direction,
+        moment_amplitude = self._least_squares(
+            coordinates, self.dipole_coordinates_, dipole_moment_direction,
+            field_direction, data, weights, stopwatch,
         )
-        moment_amplitude = vdb.least_squares(jacobian, data, weights, self.damping)
         self.dipole_moments_ = angles_to_vector(
             self.dipole_inclination, self.dipole_declination, moment_amplitude,
         )
+        self.fit_stats_ = {
+            "stages": dict(stopwatch.times),
+            "n_data": data.size,
+            "n_dipoles": self.dipole_coordinates_[0].size,
+        }
+        if self.callback is not None:
+            self.callback({"event": "fit", **self.fit_stats_})
         return self
 
-    def predict(self, coordinates):
+    def fit_path(self, coordinates, data, field_direction, dampings, weights=None):
+        """
+        Fit the dipoles for several damping values at the cost of one fit.
+
+        The Jacobian is built and decomposed (SVD) once and the solution for
+        each damping costs only a few matrix-vector products. Always uses the
+        dense Jacobian of the whole dataset (no gradient boosting). The
+        ``damping`` parameter of the estimator is ignored.
+
+        Parameters
+        ----------
+        coordinates : tuple of arrays
+            The easting, northing, and upward coordinates of the data.
+        data : array
+            The total-field anomaly data.
+        field_direction : 2d-array
+            The unit vector of the main field (from :func:`angles_to_vector`).
+        dampings : list
+            The damping values. Can include None for no damping.
+        weights : None or array
+            The data weights.
+
+        Returns
+        -------
+        dipole_moments : 3d-array
+            The dipole moments for each damping, with shape
+            ``(len(dampings), 3, n_dipoles)``. The dipole coordinates are
+            stored in ``dipole_coordinates_`` (along with ``region_`` and
+            ``depth_``, like :meth:`fit`). Assign one of the moments to
+            ``dipole_moments_`` to predict with it.
+        """
+        geometry = _as_geometry(coordinates)
+        coordinates, data, weights = vdb.check_fit_input(geometry.coordinates, data, weights)
+        self.region_ = geometry.region
+        coordinates = geometry.coordinates_1d
+        self.depth_ = self._source_depth(geometry)
+        self.dipole_coordinates_ = self._build_points(geometry, self.depth_)
+        dipole_moment_direction = angles_to_vector(
+            self.dipole_inclination, self.dipole_declination, 1,
+        )
+        jacobian = self._cached_jacobian(
+            coordinates, self.dipole_coordinates_, dipole_moment_direction, field_direction,
+        )
+        moment_amplitudes = _damping_path(jacobian, data, weights, dampings)
+        return np.array([
+            angles_to_vector(self.dipole_inclination, self.dipole_declination, amplitude)
+            for amplitude in moment_amplitudes
+        ])
+
+    def cv_score_path(
+        self, coordinates, data, field_direction, dampings, cv=None, weights=None,
+    ):
+        """
+        Cross-validation score for several damping values.
+
+        For each fold, the Jacobians of the training and testing data are
+        built once and all dampings are fitted with a damping path (see
+        :meth:`fit_path`), like in :func:`cross_validate`. The score is the
+        root-mean-square error of the predicted total-field anomaly on the
+        testing data (lower is better), averaged over the folds. The
+        estimator isn't modified.
+
+        Parameters
+        ----------
+        coordinates, data, field_direction, dampings, weights
+            See :meth:`fit_path`.
+        cv : None or cross-validator
+            A scikit-learn style cross-validator (e.g.,
+            :class:`verde.BlockKFold`). Defaults to a shuffled 5-fold
+            :class:`sklearn.model_selection.KFold`.
+
+        Returns
+        -------
+        scores : 1d-array
+            The mean score for each damping.
+        """
+        source = _cv_folds(coordinates, data, weights, cv)
+        estimators = [_with_parameters(self, dict(damping=damping)) for damping in dampings]
+        fold_scores = [
+            _cross_validate_job(estimators, source, fold, field_direction)
+            for fold in range(len(source[-1]))
+        ]
+        return np.mean(fold_scores, axis=0)
+
+    def predict(self, coordinates, tolerance=None, output="field", field_direction=None):
         """
+        Predict the magnetic field of the dipoles.
+
+        By default, returns the 3 components of the field. Use
+        ``output="tfa"`` (with *field_direction*) or ``output="norm"`` to
+        calculate the total-field anomaly or the norm of the field directly,
+        without allocating the 3 components. Use *tolerance* to approximate
+        the field of distant dipoles (see :func:`dipole_magnetic`).
         """
         # We know the gridder has been fitted if it has the estimated parameters
         sklearn.utils.validation.check_is_fitted(self, ["dipole_moments_"])
-        return np.asarray(dipole_magnetic(coordinates, self.dipole_coordinates_, self.dipole_moments_))
+        result = _magnetic_output(
+            coordinates, self.dipole_coordinates_, self.dipole_moments_, output,
+            field_direction, tolerance, self.dtype,
+        )
+        if output == "field":
+            return np.asarray(result)
+        return result
+
+    def save(self, directory, dtype=None):
+        """
+        Save the fitted model to a directory.
+
+        The dipole coordinates and moments are saved as ``.npy`` files that
+        :func:`load_equivalent_sources` can memory-map. The parameters and the
+        fitted region are saved in ``metadata.json``. Parameters that aren't
+        plain values or data types (e.g., a ``jacobian_cache`` or a
+        ``RandomState``) are saved as None with a warning. The statistics of
+        each window in ``fit_stats_`` aren't saved.
+
+        Parameters
+        ----------
+        directory : str
+            Where to save the model. Created if it doesn't exist.
+        dtype : None or str
+            Data type of the saved arrays (e.g., ``"float32"`` to halve the
+            size). Defaults to the type of the fitted arrays.
+        """
+        sklearn.utils.validation.check_is_fitted(self, ["dipole_moments_"])
+        os.makedirs(directory, exist_ok=True)
+        for name in ("dipole_coordinates", "dipole_moments"):
+            array = np.asarray(getattr(self, f"{name}_"))
+            if dtype is not None:
+                array = array.astype(dtype)
+            np.save(os.path.join(directory, f"{name}.npy"), array)
+        fitted = {
+            key: value for key, value in vars(self).items()
+            if key.endswith("_") and key not in ("dipole_coordinates_", "dipole_moments_")
+        }
+        if "fit_stats_" in fitted:
+            # The per-window list grows with the windows and repeats
+            fitted["fit_stats_"] = {
+                key: value for key, value in fitted["fit_stats_"].items()
+                if key != "windows"
+            }
+        metadata = {
+            "format_version": 1,
+            "class": type(self).__name__,
+            "parameters": {
+                key: _to_json_or_none(key, value) for key, value in vars(self).items()
+                if not key.endswith("_")
+            },
+            "fitted": {
+                key: _to_json_or_none(key, value) for key, value in fitted.items()
+            },
+        }
+        # Write the metadata last so a partially saved model can't be loaded
+        with open(os.path.join(directory, "metadata.json"), "w") as output:
+            json.dump(metadata, output, indent=2)
 
-    def _build_points(self, coordinates):
+    def _source_depth(self, coordinates):
         """
+        The depth of the dipoles below the data
         """
         if self.depth is None:
-            depth = recommended_source_depth(coordinates)
-        else:
-            depth = self.depth
-        depth = np.ones_like(coordinates[0])*depth
+            return recommended_source_depth(coordinates)
+        return self.depth
+
+    def _build_points(self, coordinates, depth=None):
+        """
+        """
+        geometry = _as_geometry(coordinates)
+        if depth is None:
+            depth = self._source_depth(geometry)
         if self.block_size is not None:
-            reducer = vd.BlockReduce(
-                spacing=self.block_size, reduction="median", drop_coords=False
-            )
-            # Must pass a dummy data array to BlockReduce.filter(), we choose
-            # one of the coordinate arrays. We will ignore the returned reduced
-            # dummy array.
-            coordinates, depth = reducer.filter(coordinates, depth)
+            coordinates = geometry.block_reduced(self.block_size)
+        else:
+            coordinates = geometry.coordinates_1d
         points = [
             coordinates[0],
             coordinates[1],
@@ -210,6 +1205,144 @@ class EquivalentSourcesMagnetic():
         ]
         return points
 
+    def _least_squares(
+        self, coordinates, dipole_coordinates, dipole_moment_direction,
+        field_direction, data, weights, stopwatch=None,
+    ):
+        """
+        Estimate the moment amplitudes with the solver chosen for this gridder.
+
+        The time spent building the Jacobian and solving is added to the
+        *stopwatch* (if given).
+        """
+        if stopwatch is None:
+            stopwatch = _Stopwatch()
+        if self.solver == "dense":
+            if self.jacobian_cache is not None and self.damping is not None:
+                return self._factorized_least_squares(
+                    coordinates, dipole_coordinates, dipole_moment_direction,
+                    field_direction, data, weights, stopwatch,
+                )
+            with stopwatch("jacobian"):
+                jacobian = self._cached_jacobian(
+                    coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+                )
+            with stopwatch("solve"):
+                # Don't scale the cached matrix in-place
+                return vdb.least_squares(
+                    jacobian, data, weights, self.damping,
+                    copy_jacobian=self.jacobian_cache is not None,
+                )
+        if self.solver == "matrix-free":
+            with stopwatch("solve"):
+                return least_squares_matrix_free(
+                    coordinates, dipole_coordinates, dipole_moment_direction,
+                    field_direction, data, weights, self.damping,
+                )
+        if self.solver == "sparse":
+            with stopwatch("jacobian"):
+                jacobian = self.jacobian_sparse(
+                    coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+                )
+            with stopwatch("solve"):
+                return least_squares_sparse(jacobian, data, weights, self.damping)
+        raise ValueError(
+            f"Invalid solver '{self.solver}'. "
+            "Must be 'dense', 'matrix-free', or 'sparse'."
+        )
+
+    def _factorized_least_squares(
+        self, coordinates, dipole_coordinates, dipole_moment_direction,
+        field_direction, data, weights, stopwatch,
+    ):
+        """
+        Damped least-squares solution using a cached Cholesky factorisation.
+
+        Same solution as verde.base.least_squares. The factorisation of the
+        damped normal equations only depends on the geometry, the weights, and
+        the damping, so fitting other data (e.g., the residuals in later
+        gradient-boosting repeats) only takes two triangular solves.
+        If the factorisation fails, the Jacobian is still cached and solved
+        with verde.base.least_squares (which falls back to an SVD).
+        """
+        arrays = [*coordinates, *dipole_coordinates, dipole_moment_direction, field_direction]
+        if weights is not None:
+            arrays.append(weights)
+        key = JacobianCache.key(
+            *arrays, dtype=np.dtype(self.dtype).str, damping=self.damping,
+            weighted=weights is not None, factorization="cholesky",
+        )
+        factorization = self.jacobian_cache.get(key)
+        if factorization is None:
+            with stopwatch("jacobian"):
+                jacobian = self.jacobian(
+                    coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+                )
+            if jacobian.shape[0] < jacobian.shape[1]:
+                warnings.warn(
+                    f"Under-determined problem detected (ndata, nparams)={jacobian.shape}."
+                )
+            with stopwatch("factorization"):
+                # Same scaling and weighting as in _damping_path
+                scale = np.std(jacobian, axis=0)
+                scale[scale == 0] = 1
+                scaled = jacobian / scale
+                if weights is not None:
+                    scaled *= np.sqrt(np.ravel(weights))[:, np.newaxis]
+                hessian = scaled.T @ scaled
+                del scaled
+                hessian[np.diag_indices_from(hessian)] += self.damping
+                try:
+                    cholesky = scipy.linalg.cholesky(
+                        hessian, lower=True, overwrite_a=True, check_finite=False,
+                    )
+                except np.linalg.LinAlgError:
+                    # Not positive definite with rounding (small damping or
+                    # float32). Remember it with empty arrays (which can be
+                    # spilled to disk, unlike None) and use verde instead.
+                    cholesky, scale = np.empty(0, dtype=jacobian.dtype), np.empty(0)
+                del hessian
+            factorization = (jacobian, cholesky, scale)
+            self.jacobian_cache.put(key, factorization)
+        jacobian, cholesky, scale = factorization
+        if cholesky.size == 0:
+            with stopwatch("solve"):
+                return vdb.least_squares(
+                    jacobian, data, weights, self.damping, copy_jacobian=True,
+                )
+        with stopwatch("solve"):
+            data = np.ravel(data)
+            if weights is not None:
+                data = data * np.ravel(weights)
+            params = scipy.linalg.cho_solve(
+                (cholesky, True), (jacobian.T @ data) / scale, check_finite=False,
+            )
+        return params / scale
+
+    def _cached_jacobian(
+        self, coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+    ):
+        """
+        Get the Jacobian from the cache (if any) or calculate and store it.
+
+        The returned array must not be modified if there is a cache.
+        """
+        if self.jacobian_cache is None:
+            return self.jacobian(
+                coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+            )
+        key = JacobianCache.key(
+            *coordinates, *dipole_coordinates, dipole_moment_direction,
+            field_direction, dtype=np.dtype(self.dtype).str,
+        )
+        jacobian = self.jacobian_cache.get(key)
+        if jacobian is None:
+            jacobian = self.jacobian(
+                coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+            )
+            self.jacobian_cache.put(key, jacobian)
+        return jacobian
+
     def jacobian(
         self, coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
     ):
@@ -217,7 +1350,7 @@ class EquivalentSourcesMagnetic():
         """
         n = len(coordinates[0])
         m = len(dipole_coordinates[0])
-        A = np.empty((n, m))
+        A = np.empty((n, m), dtype=self.dtype)
         _jacobian_fast(
             easting=coordinates[0],
             northing=coordinates[1],
@@ -235,123 +1368,1464 @@ class EquivalentSourcesMagnetic():
         )
         return A
 
+    def jacobian_sparse(
+        self, coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+    ):
+        """
+        Sparse Jacobian that ignores dipoles farther than the cutoff distance
+
+        The data and dipoles are partitioned with KD-trees to find the pairs
+        that are closer than ``cutoff``. Only those elements are calculated and
+        stored in a CSR matrix. The dipole field decays with the cube of the
+        distance, so a cutoff of about 10 times the source depth drops elements
+        smaller than ~1/1000 of the largest ones.
+        """
+        if self.cutoff is None:
+            raise ValueError("A 'cutoff' distance is required for solver='sparse'.")
+        n = len(coordinates[0])
+        m = len(dipole_coordinates[0])
+        data_tree = scipy.spatial.cKDTree(np.transpose(coordinates))
+        dipole_tree = scipy.spatial.cKDTree(np.transpose(dipole_coordinates))
+        pairs = data_tree.sparse_distance_matrix(
+            dipole_tree, max_distance=self.cutoff, output_type="ndarray",
+        )
+        values = np.empty(pairs.size, dtype=self.dtype)
+        _jacobian_sparse_fast(
+            easting=coordinates[0],
+            northing=coordinates[1],
+            upward=coordinates[2],
+            d_easting=dipole_coordinates[0],
+            d_northing=dipole_coordinates[1],
+            d_upward=dipole_coordinates[2],
+            m_easting=dipole_moment_direction[0][0],
+            m_northing=dipole_moment_direction[1][0],
+            m_upward=dipole_moment_direction[2][0],
+            f_easting=field_direction[0][0],
+            f_northing=field_direction[1][0],
+            f_upward=field_direction[2][0],
+            rows=pairs["i"],
+            columns=pairs["j"],
+            values=values,
+        )
+        A = scipy.sparse.csr_matrix((values, (pairs["i"], pairs["j"])), shape=(n, m))
+        return A
+
+
+@numba.jit(nopython=True)
+def _tfa_kernel_constants(
+    m_easting, m_northing, m_upward, f_easting, f_northing, f_upward,
+):
+    """
+    Fold the physical constants into the moment direction for _tfa_kernel
+    """
+    factor = TESLA_TO_NANOTESLA * CM
+    m_dot_f = factor * (m_easting * f_easting + m_northing * f_northing + m_upward * f_upward)
+    return 3 * factor * m_easting, 3 * factor * m_northing, 3 * factor * m_upward, m_dot_f
+
+
+@numba.jit(nopython=True)
+def _tfa_kernel(
+    r_easting, r_northing, r_upward, m_easting, m_northing, m_upward,
+    f_easting, f_northing, f_upward, m_dot_f,
+):
+    """
+    Total-field anomaly of a dipole with constant moment and field directions
+
+    Evaluates f . B = c [3 (m . r)(f . r) / r^5 - (m . f) / r^3] directly
+    instead of calculating the 3 components of B and projecting them. The
+    moment must be pre-multiplied by 3c and m_dot_f by c (see
+    _tfa_kernel_constants).
+    """
+    distance_sq = r_easting**2 + r_northing**2 + r_upward**2
+    inverse_distance = 1 / np.sqrt(distance_sq)
+    m_dot_r = m_easting * r_easting + m_northing * r_northing + m_upward * r_upward
+    f_dot_r = f_easting * r_easting + f_northing * r_northing + f_upward * r_upward
+    return inverse_distance**3 * (m_dot_r * f_dot_r / distance_sq - m_dot_f)
+
 
 @numba.jit(nopython=True, parallel=True)
 def _jacobian_fast(
     easting, northing, upward, d_easting, d_northing, d_upward, m_easting,
     m_northing, m_upward, f_easting, f_northing, f_upward, jacobian,
 ):
-        for i in numba.prange(easting.size):
-            for j in range(d_easting.size):
-                b_easting, b_northing, b_upward = choclo.dipole.magnetic_field(
-                    easting_p=easting[i],
-                    northing_p=northing[i],
-                    upward_p=upward[i],
-                    easting_q=d_easting[j],
-                    northing_q=d_northing[j],
-                    upward_q=d_upward[j],
-                    magnetic_moment_east=m_easting,
-                    magnetic_moment_north=m_northing,
-                    magnetic_moment_up=m_upward,
-                )
-                jacobian[i, j] = TESLA_TO_NANOTESLA * (
-                    b_easting * f_easting
-                    + b_northing * f_northing
-                    + b_upward * f_upward
-                )
+    """
+    Fill the Jacobian matrix with the total-field anomaly kernel
+    """
+    m_easting, m_northing, m_upward, m_dot_f = _tfa_kernel_constants(
+        m_easting, m_northing, m_upward, f_easting, f_northing, f_upward,
+    )
+    for i in numba.prange(easting.size):
+        for j in range(d_easting.size):
+            jacobian[i, j] = _tfa_kernel(
+                easting[i] - d_easting[j],
+                northing[i] - d_northing[j],
+                upward[i] - d_upward[j],
+                m_easting, m_northing, m_upward, f_easting, f_northing, f_upward, m_dot_f,
+            )
+
+
+@numba.jit(nopython=True, parallel=True)
+def _jacobian_sparse_fast(
+    easting, northing, upward, d_easting, d_northing, d_upward, m_easting,
+    m_northing, m_upward, f_easting, f_northing, f_upward, rows, columns, values,
+):
+    """
+    Calculate only the Jacobian elements given by the row and column indices
+    """
+    m_easting, m_northing, m_upward, m_dot_f = _tfa_kernel_constants(
+        m_easting, m_northing, m_upward, f_easting, f_northing, f_upward,
+    )
+    for k in numba.prange(rows.size):
+        i = rows[k]
+        j = columns[k]
+        values[k] = _tfa_kernel(
+            easting[i] - d_easting[j],
+            northing[i] - d_northing[j],
+            upward[i] - d_upward[j],
+            m_easting, m_northing, m_upward, f_easting, f_northing, f_upward, m_dot_f,
+        )
+
+
+def _damping_path(jacobian, data, weights, dampings):
+    """
+    Solve the least-squares problem of verde.base.least_squares for several
+    dampings using a single SVD of the scaled Jacobian.
+
+    Returns an array with the parameters for each damping (one per row).
+    """
+    if jacobian.shape[0] < jacobian.shape[1]:
+        warnings.warn(
+            f"Under-determined problem detected (ndata, nparams)={jacobian.shape}."
+        )
+    # Same scaling and weighting as verde.base.least_squares (through
+    # StandardScaler and Ridge/LinearRegression).
+    scale = np.std(jacobian, axis=0)
+    scale[scale == 0] = 1
+    jacobian = jacobian / scale
+    data = np.ravel(data)
+    if weights is not None:
+        sqrt_weights = np.sqrt(np.ravel(weights))
+        jacobian *= sqrt_weights[:, np.newaxis]
+        data = data * sqrt_weights
+    u, singular_values, vt = np.linalg.svd(jacobian, full_matrices=False)
+    del jacobian
+    projected_data = u.T @ data
+    params = []
+    for damping in dampings:
+        if damping is None:
+            # Pseudo-inverse with the same cutoff as numpy.linalg.lstsq
+            cutoff = np.finfo(singular_values.dtype).eps * max(u.shape[0], vt.shape[1])
+            nonzero = singular_values > cutoff * singular_values[0]
+            filters = np.zeros_like(singular_values)
+            filters[nonzero] = 1 / singular_values[nonzero]
+        else:
+            filters = singular_values / (singular_values**2 + damping)
+        params.append((vt.T @ (filters * projected_data)) / scale)
+    return np.array(params)
 
 
+def least_squares_matrix_free(
+    coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+    data, weights, damping=None, max_iterations=1000,
+):
+    """
+    Solve the damped least-squares problem without building the Jacobian.
+
+    Equivalent to ``verde.base.least_squares`` on the matrix produced by
+    :meth:`EquivalentSourcesMagnetic.jacobian` but the products of the
+    Jacobian (and its transpose) with vectors are calculated on-the-fly by
+    parallel kernels and fed to the LSQR iterative solver. Memory use is
+    O(n + m) instead of O(n x m) at the cost of re-evaluating the kernel on
+    every iteration.
+
+    Parameters
+    ----------
+    coordinates : tuple of 1d-arrays
+        The easting, northing, and upward coordinates of the data.
+    dipole_coordinates : tuple of 1d-arrays
+        The easting, northing, and upward coordinates of the dipoles.
+    dipole_moment_direction : 2d-array
+        The unit vector of the dipole moments (from :func:`angles_to_vector`).
+    field_direction : 2d-array
+        The unit vector of the main field (from :func:`angles_to_vector`).
+    data : 1d-array
+        The total-field anomaly data.
+    weights : None or 1d-array
+        The data weights. Use ``None`` to fit without weights.
+    damping : None or float
+        The positive damping regularization parameter.
+    max_iterations : int
+        Maximum number of LSQR iterations. Without damping, LSQR can take many
+        iterations to converge on ill-conditioned problems. Warns if reached.
+
+    Returns
+    -------
+    parameters : 1d-array
+        The estimated moment amplitudes of the dipoles.
+    """
+    n = len(coordinates[0])
+    m = len(dipole_coordinates[0])
+    if n < m:
+        warnings.warn(
+            f"Under-determined problem detected (ndata, nparams)={(n, m)}."
+        )
+    kernel_args = (
+        coordinates[0],
+        coordinates[1],
+        coordinates[2],
+        dipole_coordinates[0],
+        dipole_coordinates[1],
+        dipole_coordinates[2],
+        dipole_moment_direction[0][0],
+        dipole_moment_direction[1][0],
+        dipole_moment_direction[2][0],
+        field_direction[0][0],
+        field_direction[1][0],
+        field_direction[2][0],
+    )
+    # Scale the columns to unit variance, like verde.base.least_squares does,
+    # so that the damping has the same meaning for both solvers.
+    column_sum = np.zeros(m)
+    column_sum_squares = np.zeros(m)
+    _jacobian_column_sums_fast(*kernel_args, column_sum, column_sum_squares)
+    variance = column_sum_squares / n - (column_sum / n) ** 2
+    scale = np.sqrt(np.clip(variance, 0, None))
+    scale[scale == 0] = 1
+    if weights is None:
+        sqrt_weights = np.ones(n)
+    else:
+        sqrt_weights = np.sqrt(np.ravel(weights))
+
+    def matvec(vector):
+        result = np.zeros(n)
+        _jacobian_dot_fast(*kernel_args, np.ravel(vector) / scale, result)
+        return sqrt_weights * result
+
+    def rmatvec(vector):
+        result = np.zeros(m)
+        _jacobian_transpose_dot_fast(*kernel_args, sqrt_weights * np.ravel(vector), result)
+        return result / scale
+
+    operator = scipy.sparse.linalg.LinearOperator(
+        (n, m), matvec=matvec, rmatvec=rmatvec, dtype=np.float64,
+    )
+    if damping is None:
+        damp = 0
+    else:
+        damp = np.sqrt(damping)
+    return _lsqr(operator, sqrt_weights * np.ravel(data), damp, max_iterations) / scale
+
+
+def least_squares_sparse(jacobian, data, weights, damping=None, max_iterations=1000):
+    """
+    Solve the damped least-squares problem with a sparse Jacobian.
+
+    Same problem as ``verde.base.least_squares`` (columns scaled to unit
+    variance) but solved with LSQR to the same tolerance as
+    :func:`least_squares_matrix_free`. Ridge regression in scikit-learn uses
+    a much looser default tolerance for sparse matrices.
+
+    Parameters
+    ----------
+    jacobian : scipy.sparse matrix
+        The Jacobian (from :meth:`EquivalentSourcesMagnetic.jacobian_sparse`).
+    data : 1d-array
+        The total-field anomaly data.
+    weights : None or 1d-array
+        The data weights. Use ``None`` to fit without weights.
+    damping : None or float
+        The positive damping regularization parameter.
+    max_iterations : int
+        Maximum number of LSQR iterations. Without damping, LSQR can take many
+        iterations to converge on ill-conditioned problems. Warns if reached.
+
+    Returns
+    -------
+    parameters : 1d-array
+        The estimated moment amplitudes of the dipoles.
+    """
+    n, m = jacobian.shape
+    if n < m:
+        warnings.warn(
+            f"Under-determined problem detected (ndata, nparams)={(n, m)}."
+        )
+    jacobian = scipy.sparse.csr_matrix(jacobian, dtype=np.float64)
+    mean = np.ravel(jacobian.mean(axis=0))
+    mean_squares = np.ravel(jacobian.multiply(jacobian).mean(axis=0))
+    scale = np.sqrt(np.clip(mean_squares - mean**2, 0, None))
+    scale[scale == 0] = 1
+    if weights is None:
+        sqrt_weights = np.ones(n)
+    else:
+        sqrt_weights = np.sqrt(np.ravel(weights))
+    scaled = scipy.sparse.diags(sqrt_weights) @ jacobian @ scipy.sparse.diags(1 / scale)
+    if damping is None:
+        damp = 0
+    else:
+        damp = np.sqrt(damping)
+    return _lsqr(scaled, sqrt_weights * np.ravel(data), damp, max_iterations) / scale
+
+
+def _lsqr(matrix, data, damp, max_iterations):
+    """
+    Solve with LSQR to a tight tolerance and warn if it doesn't converge
+    """
+    solution, stop = scipy.sparse.linalg.lsqr(
+        matrix, data, damp=damp, atol=1e-8, btol=1e-8, iter_lim=max_iterations,
+    )[:2]
+    if stop == 7:
+        warnings.warn(
+            f"LSQR stopped after the maximum of {max_iterations} iterations "
+            "before converging. Try increasing the damping."
+        )
+    return solution
+
+
+@numba.jit(nopython=True, parallel=True)
+def _jacobian_dot_fast(
+    easting, northing, upward, d_easting, d_northing, d_upward, m_easting,
+    m_northing, m_upward, f_easting, f_northing, f_upward, vector, result,
+):
+    """
+    Multiply the Jacobian by a vector without storing the matrix
+    """
+    m_easting, m_northing, m_upward, m_dot_f = _tfa_kernel_constants(
+        m_easting, m_northing, m_upward, f_easting, f_northing, f_upward,
+    )
+    for i in numba.prange(easting.size):
+        for j in range(d_easting.size):
+            result[i] += vector[j] * _tfa_kernel(
+                easting[i] - d_easting[j],
+                northing[i] - d_northing[j],
+                upward[i] - d_upward[j],
+                m_easting, m_northing, m_upward, f_easting, f_northing, f_upward, m_dot_f,
+            )
+
+
+@numba.jit(nopython=True, parallel=True)
+def _jacobian_transpose_dot_fast(
+    easting, northing, upward, d_easting, d_northing, d_upward, m_easting,
+    m_northing, m_upward, f_easting, f_northing, f_upward, vector, result,
+):
+    """
+    Multiply the transposed Jacobian by a vector without storing the matrix
+    """
+    m_easting, m_northing, m_upward, m_dot_f = _tfa_kernel_constants(
+        m_easting, m_northing, m_upward, f_easting, f_northing, f_upward,
+    )
+    for j in numba.prange(d_easting.size):
+        for i in range(easting.size):
+            result[j] += vector[i] * _tfa_kernel(
+                easting[i] - d_easting[j],
+                northing[i] - d_northing[j],
+                upward[i] - d_upward[j],
+                m_easting, m_northing, m_upward, f_easting, f_northing, f_upward, m_dot_f,
+            )
+
+
+@numba.jit(nopython=True, parallel=True)
+def _jacobian_column_sums_fast(
+    easting, northing, upward, d_easting, d_northing, d_upward, m_easting,
+    m_northing, m_upward, f_easting, f_northing, f_upward, column_sum,
+    column_sum_squares,
+):
+    """
+    Sum of the elements and of their squares for every Jacobian column
+    """
+    m_easting, m_northing, m_upward, m_dot_f = _tfa_kernel_constants(
+        m_easting, m_northing, m_upward, f_easting, f_northing, f_upward,
+    )
+    for j in numba.prange(d_easting.size):
+        for i in range(easting.size):
+            element = _tfa_kernel(
+                easting[i] - d_easting[j],
+                northing[i] - d_northing[j],
+                upward[i] - d_upward[j],
+                m_easting, m_northing, m_upward, f_easting, f_northing, f_upward, m_dot_f,
+            )
+            column_sum[j] += element
+            column_sum_squares[j] += element**2
+
 
 class EquivalentSourcesMagneticGB(EquivalentSourcesMagnetic):
 
     def __init__(
         self, damping=None, depth=None, block_size=None,
         dipole_inclination=90, dipole_declination=0, dipole_coordinates=None,
-        window_size=None, repeat=1, random_state=None,
+        window_size=None, repeat=1, random_state=None, solver="dense",
+        cutoff=None, influence_radius=None, n_jobs=None, dtype="float64",
+        jacobian_cache=None, memory_budget=None, time_budget=None,
+        windows="rolling", max_window_data=None, callback=None, tol=None,
+        noise_level=None,
     ):
         super().__init__(
             damping, depth, block_size, dipole_inclination, dipole_declination,
-            dipole_coordinates,
+            dipole_coordinates, solver, cutoff, dtype, jacobian_cache, callback,
         )
         self.window_size = window_size
         self.repeat = repeat
         self.random_state = random_state
-       
+        self.influence_radius = influence_radius
+        self.n_jobs = n_jobs
+        self.memory_budget = memory_budget
+        self.time_budget = time_budget
+        self.windows = windows
+        self.max_window_data = max_window_data
+        self.tol = tol
+        self.noise_level = noise_level
+
     def fit(self, coordinates, data, field_direction, weights=None):
         """
         """
-        coordinates, data, weights = vdb.check_fit_input(coordinates, data, weights)
+        start = time.perf_counter()
+        geometry = _as_geometry(coordinates)
+        data, weights = vdb.check_fit_input(geometry.coordinates, data, weights)[1:]
         data = np.atleast_1d(data)
         # Capture the data region to use as a default when gridding.
-        self.region_ = vd.get_region(coordinates[:2])
-        coordinates = vdb.n_1d_arrays(coordinates, 3)
-        self.dipole_coordinates_ = self._build_points(coordinates)
+        self.region_ = geometry.region
+        self.depth_ = self._source_depth(geometry)
+        self.dipole_coordinates_ = self._build_points(geometry, self.depth_)
+        moment_amplitude = self._fit_windows(
+            geometry, np.ravel(data), weights, field_direction, self.dipole_coordinates_,
+            start,
+        )
+        self.dipole_moments_ = angles_to_vector(
+            self.dipole_inclination, self.dipole_declination, moment_amplitude,
+        )
+        if self.callback is not None:
+            self.callback({"event": "fit", **self.fit_stats_})
+        return self
+
+    def update(self, coordinates, data, field_direction, weights=None):
+        """
+        Add a new block of data (e.g., new flight lines) to the fitted model.
+
+        New dipoles are placed below the new data, at the depth of the
+        original fit (``depth_``), and fitted by gradient boosting to the
+        residuals of the current model at the new points. Only windows with
+        new data are solved and the moments of the existing dipoles don't
+        change, so the cost depends on the size of the new block (plus
+        predicting the current model on it) instead of the whole survey.
+        ``fit_stats_``, ``window_plan_``, and ``n_iter_`` describe the update.
+        """
+        sklearn.utils.validation.check_is_fitted(self, ["dipole_moments_", "depth_"])
+        start = time.perf_counter()
+        geometry = _as_geometry(coordinates)
+        data, weights = vdb.check_fit_input(geometry.coordinates, data, weights)[1:]
+        residuals = np.ravel(data) - _magnetic_output(
+            geometry.coordinates_1d, self.dipole_coordinates_, self.dipole_moments_,
+            "tfa", field_direction, None, self.dtype,
+        )
+        dipole_coordinates = self._build_points(geometry, self.depth_)
+        # Use the windows of the fit (the new block may be too small or a
+        # single line for the automatic size) and keep them for later updates
+        window_size = self.window_size_
+        moment_amplitude = self._fit_windows(
+            geometry, residuals, weights, field_direction, dipole_coordinates, start,
+            window_size,
+        )
+        self.window_size_ = window_size
+        self.dipole_coordinates_ = [
+            np.concatenate([old, new])
+            for old, new in zip(self.dipole_coordinates_, dipole_coordinates)
+        ]
+        self.dipole_moments_ = np.concatenate(
+            [
+                self.dipole_moments_,
+                angles_to_vector(
+                    self.dipole_inclination, self.dipole_declination, moment_amplitude,
+                ),
+            ],
+            axis=1,
+        )
+        self.region_ = [
+            min(self.region_[0], geometry.region[0]),
+            max(self.region_[1], geometry.region[1]),
+            min(self.region_[2], geometry.region[2]),
+            max(self.region_[3], geometry.region[3]),
+        ]
+        if self.callback is not None:
+            self.callback({"event": "fit", **self.fit_stats_})
+        return self
+
+    def _fit_windows(
+        self, geometry, data, weights, field_direction, dipole_coordinates, start,
+        window_size=None,
+    ):
+        """
+        Fit the dipoles to the data by gradient boosting over windows.
+
+        Sets the window and fit statistics attributes and returns the moment
+        amplitude of the dipoles. The rolling windows have the given
+        *window_size* (or the ``window_size`` parameter) if there is one.
+        """
+        coordinates = geometry.coordinates_1d
+        if weights is not None:
+            weights = np.ravel(weights)
         dipole_moment_direction = angles_to_vector(
             self.dipole_inclination, self.dipole_declination, 1,
         )
-        if self.window_size is None:
-            # Keep the data per window around 10k.
-            # A better way would be to figure out the RAM available and choose
-            # based on that.
-            area = (self.region_[1] - self.region_[0]) * (self.region_[3] - self.region_[2])
-            ndata = data.size
-            points_per_m2 = ndata / area
-            window_area = 5e3 / points_per_m2
-            self.window_size_ = np.sqrt(window_area)
+        if self.windows == "rolling":
+            region = geometry.region
+            if window_size is None:
+                window_size = self.window_size
+            if window_size is not None:
+                region, window_size = _block_windows(region, window_size)
+            self.window_plan_ = plan_windows(
+                coordinates, dipole_coordinates, region=region,
+                window_size=window_size, memory_budget=self.memory_budget,
+                time_budget=self.time_budget, n_jobs=self.n_jobs, dtype=self.dtype,
+            )
+            self.window_size_ = self.window_plan_["window_size"]
+            window_centers, window_sizes, data_windows, dipole_windows = _rolling_windows(
+                coordinates, dipole_coordinates, region, self.window_size_,
+                self.jacobian_cache,
+            )
+        elif self.windows == "quadtree":
+            itemsize = np.dtype(self.dtype).itemsize
+            workers = 1 if self.n_jobs is None else max(1, min(self.n_jobs, os.cpu_count() or 1))
+            if self.max_window_data is not None:
+                max_points = self.max_window_data
+            elif self.memory_budget is not None:
+                # Largest square window that fits the budget
+                max_points = int(np.sqrt(self.memory_budget / (3 * itemsize * workers)))
+            else:
+                max_points = 5000
+            window_centers, window_sizes, data_windows, dipole_windows = _quadtree_windows(
+                coordinates, dipole_coordinates, geometry.region, max_points,
+            )
+            self.window_plan_ = _window_costs(
+                np.array([w.size for w in data_windows]),
+                np.array([w.size for w in dipole_windows]),
+                itemsize, workers,
+            )
+            self.window_size_ = window_sizes.max()
+        else:
+            raise ValueError(
+                f"Invalid windows '{self.windows}'. Must be 'rolling' or 'quadtree'."
+            )
+        if self.influence_radius is not None:
+            # Only update the residuals of data inside a square around the
+            # window. The field of the window dipoles decays fast enough that
+            # data farther away barely change.
+            data_tree = geometry.tree
+
+        window_indices = list(range(len(data_windows)))
+        if self.n_jobs is not None and self.influence_radius is None:
+            raise ValueError(
+                "Running windows in parallel requires an 'influence_radius'."
+            )
+        if self.influence_radius is None:
+            colors = None
+        else:
+            # Windows whose influence areas don't overlap can be solved at the
+            # same time without changing the result. Go through the same
+            # stages in serial so that n_jobs doesn't change the result.
+            colors = _color_windows(window_centers, window_sizes + 2 * self.influence_radius)
+        if self.n_jobs is None:
+            executor = contextlib.nullcontext()
         else:
-            self.window_size_ = self.window_size
-
-        _, dipole_windows = vd.rolling_window(
-            self.dipole_coordinates_,
-            region=self.region_,
-            size=self.window_size_,
-            spacing=self.window_size_ / 2,
-        )
-        _, data_windows = vd.rolling_window(
-            coordinates,
-            region=self.region_,
-            size=self.window_size_,
-            spacing=self.window_size_ / 2
-        )
-        dipole_windows = [i[0] for i in dipole_windows.ravel()]
-        data_windows = [i[0] for i in data_windows.ravel()]
-        # remove empty windows
-        dipole_windows_nonempty = []
-        data_windows_nonempty = []
-        for dipole_window_, data_window_ in zip(dipole_windows, data_windows):
-            if dipole_window_.size > 0 and data_window_.size > 0:
-                dipole_windows_nonempty.append(dipole_window_)
-                data_windows_nonempty.append(data_window_)
-    
+            executor = _process_pool(self.n_jobs)
         residuals = data.copy()
-        moment_amplitude = np.zeros_like(self.dipole_coordinates_[0])
-        window_indices = list(range(len(data_windows_nonempty)))
-        for iteration in range(self.repeat):
-            sklearn.utils.check_random_state(self.random_state).shuffle(window_indices)
-            for window in window_indices:
-                dipole_window, data_window = dipole_windows_nonempty[window], data_windows_nonempty[window]
-                coords_chunk = tuple(c[data_window] for c in coordinates)
-                dipole_chunk = tuple(c[dipole_window] for c in self.dipole_coordinates_)
-                if weights is not None:
-                    weights_chunk = weights[data_window]
+        moment_amplitude = np.zeros_like(dipole_coordinates[0])
+        # Only send the parameters to the workers, not the fitted attributes.
+        window_estimator = _unfitted_copy(self)
+        window_estimator.callback = None
+        stopwatch = _Stopwatch()
+        stopwatch.times["setup"] = time.perf_counter() - start
+        window_stats = []
+        residual_rms = [np.sqrt(np.mean(residuals**2))]
+        skipped_windows = []
+        self.n_iter_ = 0
+        if self.callback is not None:
+            self.callback({"event": "plan", **self.window_plan_})
+        with executor:
+            for iteration in range(self.repeat):
+                windows_done, skipped = 0, 0
+                random_state = sklearn.utils.check_random_state(self.random_state)
+                random_state.shuffle(window_indices)
+                if colors is None:
+                    stages = [[window] for window in window_indices]
                 else:
-                    weights_chunk = None
-                jacobian = self.jacobian(
-                    coords_chunk, dipole_chunk, dipole_moment_direction, field_direction,
-                )
-                moment_amplitude_chunk = vdb.least_squares(
-                    jacobian, residuals[data_window], weights_chunk, self.damping,
-                )
-                dipole_moment_chunk = angles_to_vector(
-                    self.dipole_inclination, self.dipole_declination, moment_amplitude_chunk,
-                )
-                predicted = total_field_anomaly(
-                    dipole_magnetic(coordinates, dipole_chunk, dipole_moment_chunk),
-                    field_direction,
-                )
-                moment_amplitude[dipole_window] += moment_amplitude_chunk
-                residuals -= predicted
-        self.dipole_moments_ = angles_to_vector(
-            self.dipole_inclination, self.dipole_declination, moment_amplitude,
+                    color_order = np.unique(colors)
+                    random_state.shuffle(color_order)
+                    stages = [np.flatnonzero(colors == color) for color in color_order]
+                for stage in stages:
+                    tasks, updates = [], []
+                    for window in stage:
+                        dipole_window, data_window = dipole_windows[window], data_windows[window]
+                        if (
+                            self.noise_level is not None
+                            and np.sqrt(np.mean(residuals[data_window]**2)) < self.noise_level
+                        ):
+                            # Nothing left to fit here but noise
+                            skipped += 1
+                            continue
+                        if self.influence_radius is None:
+                            influenced = slice(None)
+                        else:
+                            influenced = data_tree.query_ball_point(
+                                window_centers[window],
+                                r=window_sizes[window] / 2 + self.influence_radius,
+                                p=np.inf,
+                            )
+                        if weights is not None:
+                            weights_chunk = weights[data_window]
+                        else:
+                            weights_chunk = None
+                        tasks.append((
+                            window_estimator,
+                            tuple(c[data_window] for c in coordinates),
+                            tuple(c[dipole_window] for c in dipole_coordinates),
+                            dipole_moment_direction,
+                            field_direction,
+                            residuals[data_window],
+                            weights_chunk,
+                            tuple(c[influenced] for c in coordinates),
+                        ))
+                        updates.append((window, dipole_window, influenced))
+                    if not tasks:
+                        continue
+                    if self.n_jobs is None:
+                        results = map(_fit_window, *zip(*tasks))
+                    else:
+                        results = executor.map(_fit_window, *zip(*tasks))
+                    # Windows in a stage don't overlap so the order of the updates
+                    # doesn't matter.
+                    for (window, dipole_window, influenced), result in zip(updates, results):
+                        moment_amplitude_chunk, predicted, stats = result
+                        with stopwatch("update"):
+                            moment_amplitude[dipole_window] += moment_amplitude_chunk
+                            residuals[influenced] -= predicted
+                        windows_done += 1
+                        stats = {"iteration": iteration, "window": int(window), **stats}
+                        window_stats.append(stats)
+                        if self.callback is not None:
+                            self.callback({
+                                "event": "window", "windows_done": windows_done,
+                                "n_windows": len(window_indices), **stats,
+                            })
+                residual_rms.append(np.sqrt(np.mean(residuals**2)))
+                skipped_windows.append(skipped)
+                self.n_iter_ = iteration + 1
+                if self.callback is not None:
+                    self.callback({
+                        "event": "iteration", "iteration": iteration,
+                        "residual_rms": residual_rms[-1], "skipped_windows": skipped,
+                        "time": time.perf_counter() - start,
+                    })
+                if skipped == len(window_indices):
+                    break
+                if (
+                    self.tol is not None
+                    and residual_rms[-2] - residual_rms[-1] <= self.tol * residual_rms[-2]
+                ):
+                    # Another sweep wouldn't improve the fit by much
+                    break
+        stages = dict(stopwatch.times)
+        for stage in ("jacobian", "factorization", "solve", "predict"):
+            if any(stage in stats for stats in window_stats):
+                stages[stage] = sum(stats.get(stage, 0) for stats in window_stats)
+        stages["total"] = time.perf_counter() - start
+        self.fit_stats_ = {
+            "stages": stages,
+            "n_data": data.size,
+            "n_dipoles": dipole_coordinates[0].size,
+            "windows": window_stats,
+            "residual_rms": residual_rms,
+            "skipped_windows": skipped_windows,
+        }
+        return moment_amplitude
+
+
+def plan_windows(
+    coordinates, dipole_coordinates, region=None, window_size=None,
+    memory_budget=None, time_budget=None, n_jobs=None, dtype="float64",
+):
+    """
+    Choose the window size for gradient-boosted equivalent sources.
+
+    Counts the data and dipoles that fall in each window (using the same
+    layout as :func:`verde.rolling_window`, with windows overlapping by half
+    their size) to estimate the peak memory and the run time of the window
+    solves. The largest window that fits both budgets is chosen. If no budget
+    is given, the windows have around 5000 data on average.
+
+    Parameters
+    ----------
+    coordinates : tuple of arrays
+        Easting, northing, and upward coordinates of the data.
+    dipole_coordinates : tuple of arrays
+        Coordinates of the dipoles.
+    region : None or list
+        The data region. Defaults to the region of the coordinates.
+    window_size : None or float
+        Use this window size instead of choosing one (only report the plan).
+    memory_budget : None or float
+        Maximum memory in bytes used by the window solves at the same time.
+    time_budget : None or float
+        Maximum estimated time in seconds for a single pass over the windows.
+    n_jobs : None or int
+        Number of windows solved in parallel. Limited by the number of CPU
+        cores.
+    dtype : str
+        Data type of the Jacobian matrices.
+
+    Returns
+    -------
+    plan : dict
+        The ``window_size``, the ``spacing`` between window centres, the
+        number of non-empty windows (``n_windows``), the largest number of
+        data (``max_data``) and dipoles (``max_dipoles``) in a window, the
+        estimated ``peak_memory`` in bytes, and the ``estimated_time`` in
+        seconds of one pass over the windows.
+    """
+    if region is None:
+        region = vd.get_region(coordinates[:2])
+    itemsize = np.dtype(dtype).itemsize
+    workers = 1 if n_jobs is None else max(1, min(n_jobs, os.cpu_count() or 1))
+    width = min(region[1] - region[0], region[3] - region[2])
+
+    def plan(size):
+        ndata = _window_counts(coordinates, region, size)
+        ndipoles = _window_counts(dipole_coordinates, region, size)
+        nonempty = (ndata > 0) & (ndipoles > 0)
+        return {
+            "window_size": size,
+            "spacing": size / 2,
+            **_window_costs(ndata[nonempty], ndipoles[nonempty], itemsize, workers),
+        }
+
+    if window_size is not None:
+        return plan(window_size)
+    if memory_budget is None and time_budget is None:
+        # Keep the data per window around 5k.
+        area = (region[1] - region[0]) * (region[3] - region[2])
+        points_per_m2 = coordinates[0].size / area
+        return plan(min(np.sqrt(5e3 / points_per_m2), width))
+    # Try sizes from the whole region down to windows with a single datum.
+    # Stop before the histograms have many more cells than points: smaller
+    # windows only split repeated points (e.g., crossing lines) and the
+    # histograms would run out of memory.
+    max_cells = 16 * (coordinates[0].size + dipole_coordinates[0].size)
+    min_size = 2 * np.sqrt((region[1] - region[0]) * (region[3] - region[2]) / max_cells)
+    if memory_budget is not None and memory_budget < 3 * itemsize * workers:
+        # Not even a window with one datum and one dipole fits
+        min_size = width
+    candidate = None
+    for size in width / 2 ** (np.arange(60) / 4):
+        if candidate is not None and size < min_size:
+            break
+        candidate = plan(size)
+        fits_memory = memory_budget is None or candidate["peak_memory"] <= memory_budget
+        fits_time = time_budget is None or candidate["estimated_time"] <= time_budget
+        if fits_memory and fits_time:
+            return candidate
+        if candidate["max_data"] <= 1:
+            break
+    warnings.warn(
+        "No window size fits the memory and time budgets. "
+        f"Using the smallest one tried ({candidate['window_size']:g})."
+    )
+    return candidate
+
+
+def _block_windows(region, size):
+    """
+    Region and size of the rolling windows over a block of data.
+
+    The size is clipped to the narrowest side of the block. Blocks narrower
+    than half a window (e.g., a single flight line) keep the window size and
+    the windows cover the block grown by half a window instead.
+    """
+    width = min(region[1] - region[0], region[3] - region[2])
+    if width >= size / 2:
+        return region, min(size, width)
+    grown = [
+        dimension + (-1) ** (i % 2 + 1) * size / 2 for i, dimension in enumerate(region)
+    ]
+    return grown, size
+
+
+def _window_costs(ndata, ndipoles, itemsize, workers):
+    """
+    Estimated peak memory and time of solving windows with the given numbers
+    of data and dipoles
+    """
+    # Jacobian, its scaled copy, and the normal equations
+    memory = itemsize * (2 * ndata * ndipoles + ndipoles**2)
+    # Building the normal equations dominates the cost of a window
+    flops = 2 * ndata * ndipoles**2 + ndipoles**3 / 3
+    return {
+        "n_windows": int(ndata.size),
+        "max_data": int(ndata.max(initial=0)),
+        "max_dipoles": int(ndipoles.max(initial=0)),
+        "peak_memory": int(workers * memory.max(initial=0)),
+        "estimated_time": float(flops.sum() / (workers * _flop_rate())),
+    }
+
+
+def _rolling_windows(coordinates, dipole_coordinates, region, size, cache=None):
+    """
+    Non-empty rolling windows of the given size spaced by half their size
+
+    Returns the window centers, sizes, and the indices of the data and dipoles
+    in each window. The window indices are kept in the *cache* (if any) so
+    refitting the same coordinates doesn't build them again.
+    """
+    indexes = []
+    for points in (coordinates, dipole_coordinates):
+        key = JacobianCache.key(
+            points[0], points[1], np.asarray(region, dtype="float64"),
+            size=float(size), kind="rolling-window-index",
+        )
+        index = None if cache is None else cache.get(key)
+        if index is None:
+            index = rolling_window_index(points, size, region=region)
+            if cache is not None:
+                cache.put(key, (index.centers, index.offsets, index.indices))
+        else:
+            index = WindowIndex(*index)
+        indexes.append(index)
+    data_windows, dipole_windows = indexes
+    # remove empty windows
+    nonempty = (data_windows.counts > 0) & (dipole_windows.counts > 0)
+    data_windows = data_windows.take(nonempty)
+    dipole_windows = dipole_windows.take(nonempty)
+    return (
+        data_windows.centers,
+        np.full(len(data_windows), size),
+        data_windows,
+        dipole_windows,
+    )
+
+
+class WindowIndex():
+    """
+    Indices of the points inside each window in compressed sparse row layout.
+
+    The indices of the points in window ``i`` are
+    ``indices[offsets[i]:offsets[i + 1]]`` (also given by ``index[i]``).
+
+    Parameters
+    ----------
+    centers : 2d-array
+        Easting and northing of the window centers, one window per row.
+    offsets : 1d-array
+        Start of each window in *indices* plus the total number of indices at
+        the end.
+    indices : 1d-array
+        The point indices of all windows, one window after the other.
+    """
+
+    def __init__(self, centers, offsets, indices):
+        self.centers = np.asarray(centers)
+        self.offsets = np.asarray(offsets)
+        self.indices = np.asarray(indices)
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, window):
+        return self.indices[self.offsets[window]:self.offsets[window + 1]]
+
+    @property
+    def counts(self):
+        """
+        Number of points in each window
+        """
+        return np.diff(self.offsets)
+
+    def take(self, windows):
+        """
+        Index with only some of the windows (a boolean mask or window numbers)
+        """
+        windows = np.arange(len(self))[windows]
+        counts = self.counts[windows]
+        offsets = np.zeros(windows.size + 1, dtype=self.offsets.dtype)
+        np.cumsum(counts, out=offsets[1:])
+        # Position of every kept index in the old flat array
+        positions = (
+            np.repeat(self.offsets[windows] - offsets[:-1], counts)
+            + np.arange(offsets[-1])
+        )
+        return WindowIndex(self.centers[windows], offsets, self.indices[positions])
+
+
+def rolling_window_index(coordinates, size, region=None):
+    """
+    Index of the points in rolling windows spaced by half their size.
+
+    Same windows as :func:`verde.rolling_window` with ``spacing=size/2``
+    (window ``i`` is ``verde.rolling_window(...)[1].ravel()[i]``) but built
+    in a single vectorised pass. Each point is assigned to the windows whose
+    centers are within ``size/2`` of it and the (window, point) pairs are
+    sorted by window. The indices are in increasing order in each window.
+
+    Parameters
+    ----------
+    coordinates : tuple of arrays
+        Easting and northing of the points (other coordinates are ignored).
+    size : float
+        The side of the square windows.
+    region : None or list
+        The region covered by the windows. Defaults to the region of the
+        coordinates.
+
+    Returns
+    -------
+    index : :class:`WindowIndex`
+        The window centers and the point indices of each window.
+    """
+    easting, northing = (np.ravel(c) for c in coordinates[:2])
+    if region is None:
+        region = vd.get_region((easting, northing))
+    region_min_width = min(region[1] - region[0], region[3] - region[2])
+    if region_min_width < size:
+        raise ValueError(
+            f"Window size '{size}' is larger than dimensions of the region '{region}'."
+        )
+    window_region = [
+        dimension + (-1) ** (i % 2) * size / 2 for i, dimension in enumerate(region)
+    ]
+    for i in (0, 2):
+        if window_region[i] > window_region[i + 1]:
+            # Rounding swaps the bounds when the window is as wide as the region
+            window_region[i] = window_region[i + 1] = (region[i] + region[i + 1]) / 2
+    center_easting, center_northing = vd.grid_coordinates(window_region, spacing=size / 2)
+    center_easting, center_northing = center_easting[0], center_northing[:, 0]
+    windows_easting, inside_easting = _window_overlaps(easting, center_easting, size)
+    windows_northing, inside_northing = _window_overlaps(northing, center_northing, size)
+    # All combinations of the easting and northing windows of each point. The
+    # flattened arrays are ordered by point.
+    inside = (inside_northing[:, :, np.newaxis] & inside_easting[:, np.newaxis, :]).ravel()
+    window = (
+        windows_northing[:, :, np.newaxis] * center_easting.size
+        + windows_easting[:, np.newaxis, :]
+    ).ravel()[inside]
+    points = np.flatnonzero(inside) // (windows_easting.shape[1] * windows_northing.shape[1])
+    nwindows = center_easting.size * center_northing.size
+    offsets = np.zeros(nwindows + 1, dtype="int64")
+    np.cumsum(np.bincount(window, minlength=nwindows), out=offsets[1:])
+    indices = np.empty_like(points)
+    _counting_sort_fast(window, points, offsets, indices)
+    centers = np.transpose([
+        np.tile(center_easting, center_northing.size),
+        np.repeat(center_northing, center_easting.size),
+    ])
+    return WindowIndex(centers, offsets, indices)
+
+
+@numba.jit(nopython=True)
+def _counting_sort_fast(keys, values, offsets, out):
+    """
+    Stable sort of the values by their keys given the start of each key
+    """
+    position = offsets[:-1].copy()
+    for i in range(keys.size):
+        out[position[keys[i]]] = values[i]
+        position[keys[i]] += 1
+
+
+def _window_overlaps(values, centers, size):
+    """
+    The 1D windows of the given size around the (regularly spaced) centers
+    that may contain each point and whether they do (one row per point)
+    """
+    spacing = (centers[-1] - centers[0]) / max(centers.size - 1, 1)
+    if spacing > 0:
+        # Take one extra window on each side to be safe with rounding. The
+        # exact test decides.
+        first = np.floor((values - size / 2 - centers[0]) / spacing).astype("int64")
+        last = np.ceil((values + size / 2 - centers[0]) / spacing).astype("int64")
+        first = np.clip(first, 0, centers.size - 1)
+        last = np.clip(last, 0, centers.size - 1)
+    else:
+        # The window size is the region width so all centers are the same and
+        # any window may contain the point
+        first = np.zeros(values.size, dtype="int64")
+        last = np.full(values.size, centers.size - 1, dtype="int64")
+    windows = first[:, np.newaxis] + np.arange(int((last - first).max(initial=0)) + 1)
+    inside = windows <= last[:, np.newaxis]
+    windows[~inside] = 0
+    inside &= np.abs(values[:, np.newaxis] - centers[windows]) <= size / 2
+    return windows, inside
+
+
+def _quadtree_windows(coordinates, dipole_coordinates, region, max_points):
+    """
+    Windows around the cells of a quadtree of the region
+
+    Cells are split in four until their window (the cell grown by half its
+    size on each side, which gives the same overlap as the rolling windows)
+    has at most *max_points* data and dipoles. Cells without data or dipoles
+    are dropped. Returns the same as _rolling_windows.
+    """
+    root_size = max(region[1] - region[0], region[3] - region[2])
+    min_size = root_size / 2**20
+    centers, sizes, data_windows, dipole_windows = [], [], [], []
+    cells = [(
+        (region[0] + region[1]) / 2, (region[2] + region[3]) / 2, root_size,
+        np.arange(coordinates[0].size), np.arange(dipole_coordinates[0].size),
+    )]
+    while cells:
+        easting, northing, size, data_candidates, dipole_candidates = cells.pop()
+        data_window = _inside_square(coordinates, data_candidates, easting, northing, size)
+        dipole_window = _inside_square(
+            dipole_coordinates, dipole_candidates, easting, northing, size,
+        )
+        in_cell = (
+            _inside_square(coordinates, data_window, easting, northing, size / 2).size
+            + _inside_square(dipole_coordinates, dipole_window, easting, northing, size / 2).size
+        )
+        if in_cell == 0 or data_window.size == 0 or dipole_window.size == 0:
+            continue
+        if max(data_window.size, dipole_window.size) <= max_points or size <= min_size:
+            centers.append((easting, northing))
+            sizes.append(2 * size)
+            data_windows.append(data_window)
+            dipole_windows.append(dipole_window)
+            continue
+        for shift_easting in (-1, 1):
+            for shift_northing in (-1, 1):
+                cells.append((
+                    easting + shift_easting * size / 4,
+                    northing + shift_northing * size / 4,
+                    size / 2,
+                    data_window,
+                    dipole_window,
+                ))
+    return np.reshape(centers, (-1, 2)), np.array(sizes), data_windows, dipole_windows
+
+
+def _inside_square(coordinates, indices, easting, northing, half_width):
+    """
+    The indices of the points that are inside a square
+    """
+    inside = (
+        (np.abs(coordinates[0][indices] - easting) <= half_width)
+        & (np.abs(coordinates[1][indices] - northing) <= half_width)
+    )
+    return indices[inside]
+
+
+def _window_counts(coordinates, region, size):
+    """
+    Number of points in each rolling window of the given size
+
+    Windows are spaced by half their size so each is made of 2 x 2 cells of a
+    2D histogram.
+    """
+    spacing = size / 2
+    bins = [
+        max(2, int(np.ceil((region[1] - region[0]) / spacing))),
+        max(2, int(np.ceil((region[3] - region[2]) / spacing))),
+    ]
+    counts = np.histogram2d(
+        coordinates[0], coordinates[1], bins=bins,
+        range=[
+            [region[0], region[0] + bins[0] * spacing],
+            [region[2], region[2] + bins[1] * spacing],
+        ],
+    )[0].astype("int64")
+    return (counts[:-1, :-1] + counts[1:, :-1] + counts[:-1, 1:] + counts[1:, 1:]).ravel()
+
+
+@functools.lru_cache(maxsize=None)
+def _flop_rate():
+    """
+    Rough floating-point operations per second of a dense matrix product
+    """
+    size = 512
+    matrix = np.ones((size, size))
+    matrix @ matrix
+    start = time.perf_counter()
+    matrix @ matrix
+    return 2 * size**3 / max(time.perf_counter() - start, 1e-6)
+
+
+def _fit_window(
+    estimator, coordinates, dipole_coordinates, dipole_moment_direction,
+    field_direction, residuals, weights, influenced_coordinates,
+):
+    """
+    Fit the dipoles of a single window and predict their effect on the data
+
+    Also returns the sizes of the window and the time spent in each stage.
+    """
+    stopwatch = _Stopwatch()
+    moment_amplitude = estimator._least_squares(
+        coordinates, dipole_coordinates, dipole_moment_direction,
+        field_direction, residuals, weights, stopwatch,
+    )
+    dipole_moments = angles_to_vector(
+        estimator.dipole_inclination, estimator.dipole_declination, moment_amplitude,
+    )
+    with stopwatch("predict"):
+        predicted = _magnetic_output(
+            influenced_coordinates, dipole_coordinates, dipole_moments, "tfa",
+            field_direction, None, estimator.dtype,
+        )
+    stats = {
+        "n_data": residuals.size,
+        "n_dipoles": dipole_coordinates[0].size,
+        "n_influenced": predicted.size,
+        **stopwatch.times,
+    }
+    return moment_amplitude, predicted, stats
+
+
+class _Stopwatch():
+    """
+    Total time spent in each stage of a fit
+    """
+
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[stage] += time.perf_counter() - start
+
+
+def _process_pool(n_jobs):
+    """
+    Process pool whose workers share the Numba threads between them
+    """
+    # Forking after Numba has started its thread pool can deadlock so start
+    # the workers from scratch.
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=numba.set_num_threads,
+        initargs=(max(1, numba.config.NUMBA_NUM_THREADS // n_jobs),),
+    )
+
+
+def _unfitted_copy(estimator):
+    """
+    Copy of the estimator with only its parameters (no fitted attributes)
+    """
+    copy = object.__new__(type(estimator))
+    copy.__dict__.update(
+        {key: value for key, value in vars(estimator).items() if not key.endswith("_")}
+    )
+    return copy
+
+
+def _color_windows(centers, distance):
+    """
+    Greedy colouring of windows so that windows with the same colour have
+    centers farther apart than *distance* (in both horizontal directions).
+
+    The *distance* can be an array with one extent per window. Then windows
+    i and j conflict if their centers are within (distance[i] + distance[j]) / 2.
+    """
+    tree = scipy.spatial.cKDTree(centers)
+    if np.ndim(distance) == 0:
+        neighbors = tree.query_ball_point(centers, r=distance, p=np.inf)
+    else:
+        distance = np.asarray(distance)
+        neighbors = [
+            [
+                other for other in candidates
+                if np.max(np.abs(centers[window] - centers[other]))
+                <= (distance[window] + distance[other]) / 2
+            ]
+            for window, candidates in enumerate(
+                tree.query_ball_point(centers, r=(distance + distance.max()) / 2, p=np.inf)
+            )
+        ]
+    colors = np.full(len(centers), -1)
+    for window, window_neighbors in enumerate(neighbors):
+        used = set(colors[window_neighbors])
+        color = 0
+        while color in used:
+            color += 1
+        colors[window] = color
+    return colors
+
+
+def cross_validate(
+    estimator, coordinates, data, field_direction, parameter_sets, cv=None,
+    weights=None, n_jobs=None,
+):
+    """
+    Cross-validation score of an estimator for several sets of parameters.
+
+    The (parameter set, fold) combinations are distributed over a pool of
+    processes and the Numba threads are split between the workers. For
+    :class:`EquivalentSourcesMagnetic` with the dense solver, parameter sets
+    that only differ in ``damping`` share the same Jacobian in each fold and
+    are solved together with a damping path (see
+    :meth:`EquivalentSourcesMagnetic.fit_path`). Other estimators are fitted
+    once per parameter set and fold.
+
+    The score is the root-mean-square error of the predicted total-field
+    anomaly on the testing data (lower is better).
+
+    Parameters
+    ----------
+    estimator : EquivalentSourcesMagnetic or EquivalentSourcesMagneticGB
+        The estimator to validate. Parameters not in *parameter_sets* are
+        taken from it. It's not modified.
+    coordinates, data, field_direction, weights
+        The data used for the fit (see :meth:`EquivalentSourcesMagnetic.fit`).
+    parameter_sets : list of dict
+        The estimator parameters to try, e.g. ``[dict(damping=1, depth=1e3),
+        ...]``.
+    cv : None or cross-validator
+        A scikit-learn style cross-validator (e.g.,
+        :class:`verde.BlockKFold`). Defaults to a shuffled 5-fold
+        :class:`sklearn.model_selection.KFold`.
+    n_jobs : None or int
+        Number of worker processes. If None, runs in the current process.
+
+    Returns
+    -------
+    scores : pandas.DataFrame
+        One row per parameter set and fold with the parameters, the
+        ``parameter_set`` index, the ``fold`` index, and the ``score``.
+    """
+    coordinates, data, weights, splits = _cv_folds(coordinates, data, weights, cv)
+    # Group the parameter sets that can share a Jacobian
+    groups = {}
+    for index, parameters in enumerate(parameter_sets):
+        candidate = _with_parameters(estimator, parameters)
+        if type(candidate) is EquivalentSourcesMagnetic and candidate.solver == "dense":
+            key = repr(sorted((k, v) for k, v in parameters.items() if k != "damping"))
+        else:
+            key = index
+        groups.setdefault(key, []).append(index)
+    jobs = [(fold, group) for fold in range(len(splits)) for group in groups.values()]
+    estimators = [
+        [_with_parameters(estimator, parameter_sets[i]) for i in group] for _, group in jobs
+    ]
+    # The jobs only get the fold number. The workers take the fold out of
+    # memory-mapped copies of the data so that there is a single copy of the
+    # data no matter how many jobs are queued.
+    if n_jobs is None:
+        executor = contextlib.nullcontext()
+        map_function = map
+        directory = contextlib.nullcontext()
+        source = (coordinates, data, weights, splits)
+    else:
+        executor = _process_pool(n_jobs)
+        map_function = executor.map
+        directory = tempfile.TemporaryDirectory()
+        source = directory.name
+        _save_fold_arrays(source, coordinates, data, weights, splits)
+    with directory, executor:
+        results = list(map_function(
+            _cross_validate_job,
+            estimators,
+            [source] * len(jobs),
+            [fold for fold, _ in jobs],
+            [field_direction] * len(jobs),
+        ))
+    rows = []
+    for (fold, group), scores in zip(jobs, results):
+        for index, score in zip(group, scores):
+            rows.append(
+                dict(parameter_sets[index], parameter_set=index, fold=fold, score=score)
+            )
+    return pd.DataFrame(rows).sort_values(["parameter_set", "fold"], ignore_index=True)
+
+
+def _cv_folds(coordinates, data, weights, cv):
+    """
+    The checked data and the (train, test) indices of each cross-validation
+    fold (the default is a shuffled 5-fold KFold)
+    """
+    geometry = _as_geometry(coordinates)
+    data, weights = vdb.check_fit_input(geometry.coordinates, data, weights)[1:]
+    coordinates = geometry.coordinates_1d
+    if cv is None:
+        cv = sklearn.model_selection.KFold(shuffle=True, random_state=0)
+    splits = list(cv.split(np.transpose(coordinates[:2])))
+    return coordinates, data, weights, splits
+
+
+def _save_fold_arrays(directory, coordinates, data, weights, splits):
+    """
+    Save the data and the indices of each fold to be memory-mapped by the
+    cross-validation workers
+    """
+    np.save(os.path.join(directory, "coordinates.npy"), np.array(coordinates))
+    np.save(os.path.join(directory, "data.npy"), data)
+    if weights is not None:
+        np.save(os.path.join(directory, "weights.npy"), weights)
+    for fold, (train, test) in enumerate(splits):
+        np.save(os.path.join(directory, f"train-{fold}.npy"), train)
+        np.save(os.path.join(directory, f"test-{fold}.npy"), test)
+
+
+def _load_fold_arrays(source, fold):
+    """
+    The training and testing data of a fold from the arrays or the directory
+    written by _save_fold_arrays
+    """
+    if isinstance(source, str):
+        path = functools.partial(os.path.join, source)
+        coordinates = np.load(path("coordinates.npy"), mmap_mode="r")
+        data = np.load(path("data.npy"), mmap_mode="r")
+        weights = None
+        if os.path.exists(path("weights.npy")):
+            weights = np.load(path("weights.npy"), mmap_mode="r")
+        train = np.load(path(f"train-{fold}.npy"))
+        test = np.load(path(f"test-{fold}.npy"))
+    else:
+        coordinates, data, weights, splits = source
+        train, test = splits[fold]
+    return (
+        tuple(np.asarray(c[train]) for c in coordinates),
+        np.asarray(data[train]),
+        None if weights is None else np.asarray(weights[train]),
+        tuple(np.asarray(c[test]) for c in coordinates),
+        np.asarray(data[test]),
+    )
+
+
+def _cross_validate_job(estimators, source, fold, field_direction):
+    """
+    Fit and score estimators on a single fold. If there are several, they
+    differ only in their damping and use a damping path.
+    """
+    (
+        train_coordinates, train_data, train_weights, test_coordinates, test_data,
+    ) = _load_fold_arrays(source, fold)
+    if len(estimators) == 1:
+        estimator = estimators[0].fit(
+            train_coordinates, train_data, field_direction, train_weights,
+        )
+        predicted = estimator.predict(
+            test_coordinates, output="tfa", field_direction=field_direction,
+        )
+        return [np.sqrt(np.mean((test_data - predicted) ** 2))]
+    estimator = estimators[0]
+    dipole_coordinates = estimator._build_points(train_coordinates)
+    dipole_moment_direction = angles_to_vector(
+        estimator.dipole_inclination, estimator.dipole_declination, 1,
+    )
+    jacobian = estimator._cached_jacobian(
+        train_coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+    )
+    moment_amplitudes = _damping_path(
+        jacobian, train_data, train_weights, [e.damping for e in estimators],
+    )
+    jacobian = estimator._cached_jacobian(
+        test_coordinates, dipole_coordinates, dipole_moment_direction, field_direction,
+    )
+    predicted = jacobian @ moment_amplitudes.T
+    return np.sqrt(np.mean((test_data[:, np.newaxis] - predicted) ** 2, axis=0))
+
+
+def _with_parameters(estimator, parameters):
+    """
+    Unfitted copy of the estimator with some of its parameters replaced
+    """
+    copy = _unfitted_copy(estimator)
+    for name, value in parameters.items():
+        if name not in vars(copy) or name.endswith("_"):
+            raise ValueError(f"Invalid parameter '{name}' for {type(estimator).__name__}.")
+        setattr(copy, name, value)
+    return copy
+
+
+class DualLayerEquivalentSources():
+    """
+    Deep and shallow layers of equivalent sources fitted in sequence.
+
+    The deep layer (an :class:`EquivalentSourcesMagnetic`) is fitted to the
+    block-median reduced data to capture the long wavelengths. Its prediction
+    on the data points is cached and removed from the data, and the shallow
+    layer (an :class:`EquivalentSourcesMagneticGB`) is fitted to the
+    residuals. Predictions evaluate the dipoles of both layers together.
+
+    Parameters
+    ----------
+    deep : EquivalentSourcesMagnetic
+        The (unfitted) estimator used for the deep layer. It's copied, not
+        modified.
+    shallow : EquivalentSourcesMagneticGB
+        The (unfitted) estimator used for the shallow layer. It's copied, not
+        modified.
+    block_size : None or float
+        Size of the blocks used to reduce the data (by the median) before
+        fitting the deep layer. If None, the deep layer uses all data.
+    """
+
+    def __init__(self, deep, shallow, block_size=None):
+        self.deep = deep
+        self.shallow = shallow
+        self.block_size = block_size
+
+    def fit(self, coordinates, data, field_direction, weights=None):
+        """
+        Fit the deep layer and then the shallow layer to its residuals.
+        """
+        geometry = _as_geometry(coordinates)
+        coordinates, data, weights = vdb.check_fit_input(geometry.coordinates, data, weights)
+        self.region_ = geometry.region
+        coordinates = geometry.coordinates_1d
+        if self.block_size is None:
+            coords_blocked, data_blocked, weights_blocked = coordinates, data, weights
+        else:
+            reducer = vd.BlockReduce(
+                spacing=self.block_size, reduction="median", drop_coords=False,
+            )
+            # The median doesn't take weights so the deep layer is unweighted.
+            coords_blocked, data_blocked = reducer.filter(coordinates, data)
+            weights_blocked = None
+        self.deep_ = _unfitted_copy(self.deep)
+        self.deep_.fit(coords_blocked, data_blocked, field_direction, weights_blocked)
+        self.deep_prediction_ = self.deep_.predict(
+            coordinates, output="tfa", field_direction=field_direction,
+        )
+        return self.fit_shallow(geometry, data, field_direction, weights)
+
+    def fit_shallow(self, coordinates, data, field_direction, weights=None):
+        """
+        Refit only the shallow layer reusing the cached deep-layer prediction.
+
+        The coordinates must be the same ones passed to :meth:`fit`. Useful to
+        try different shallow layer parameters by changing ``shallow``.
+        """
+        sklearn.utils.validation.check_is_fitted(self, ["deep_prediction_"])
+        geometry = _as_geometry(coordinates)
+        data, weights = vdb.check_fit_input(geometry.coordinates, data, weights)[1:]
+        if data.size != self.deep_prediction_.size:
+            raise ValueError(
+                f"Data size ({data.size}) doesn't match the cached deep-layer "
+                f"prediction ({self.deep_prediction_.size})."
+            )
+        self.shallow_ = _unfitted_copy(self.shallow)
+        self.shallow_.fit(
+            geometry, np.ravel(data) - self.deep_prediction_, field_direction,
+            None if weights is None else np.ravel(weights),
+        )
+        return self
+
+    def predict(
+        self, coordinates, tolerance=None, output="field", field_direction=None,
+        dtype=None,
+    ):
+        """
+        Predict the magnetic field of both layers in one pass.
+
+        See :meth:`EquivalentSourcesMagnetic.predict` for the options. The
+        prediction is float32 only if both layers use ``dtype="float32"``
+        (or if *dtype* says so).
+        """
+        sklearn.utils.validation.check_is_fitted(self, ["shallow_"])
+        result = predict_layers(
+            [self.deep_, self.shallow_], coordinates, output=output,
+            field_direction=field_direction, tolerance=tolerance, dtype=dtype,
         )
-        return self
\ No newline at end of file
+        if output == "field":
+            return np.asarray(result)
+        return result
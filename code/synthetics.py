@@ -4,33 +4,134 @@ Module with custom functions for running synthetic datasets.
 import numpy as np
 import verde as vd
 import eqs_magnetics as eqs
-import harmonica as hm
 
-def generate_profile(first, last, size, height, magnitude, direction):
-    coords = vd.profile_coordinates(first, last, size=size, extra_coords=height)[0]
-    moments = np.array(hm.magnetic_angles_to_vec(np.full(size, magnitude), direction[0], direction[1]))
-    return coords, moments
 
-def generate_source(source, height, magnitude, profiles, grid=None):
-    coordinates = []
-    dipole_moments = []
+class SourceBuilder():
+    """
+    Declarative builder for the dipoles of a synthetic model.
+
+    Describe the sources with :meth:`profile`, :meth:`grid`, :meth:`scatter`
+    and :meth:`points` (directions are ``[inclination, declination]``). Nothing
+    is generated until :meth:`build`, which fills one preallocated ``(3, n)``
+    array of coordinates and one of moments. Their rows are contiguous so they
+    go straight into :func:`eqs_magnetics.dipole_magnetic` without copies. The
+    same builder can be built many times (e.g. for Monte Carlo ensembles with
+    different ``directions``).
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    @property
+    def size(self):
+        "Total number of dipoles"
+        return sum(part[1] for part in self.parts)
+
+    def profile(self, first, last, size, height, magnitude, direction):
+        "Dipoles evenly spaced along a straight line from first to last"
+        self.parts.append(("profile", size, (first, last, height), magnitude, direction))
+        return self
+
+    def grid(self, region, shape, height, magnitude, direction):
+        "Dipoles on a regular grid"
+        size = shape[0] * shape[1]
+        self.parts.append(("grid", size, (region, shape, height), magnitude, direction))
+        return self
+
+    def scatter(self, region, size, height, magnitude, direction, random_state=None):
+        "Dipoles randomly scattered in the region"
+        self.parts.append(("scatter", size, (region, random_state, height), magnitude, direction))
+        return self
+
+    def points(self, coordinates, magnitude, direction):
+        "Dipoles at the given easting, northing, upward coordinates"
+        coordinates = tuple(np.ravel(c) for c in coordinates)
+        self.parts.append(("points", coordinates[0].size, coordinates, magnitude, direction))
+        return self
+
+    def build(self, directions=None):
+        """
+        Generate the coordinates and moments of all dipoles.
+
+        Parameters
+        ----------
+        directions : list or None
+            Replacement ``[inclination, declination]`` for each part (in the
+            order they were added). If None, use the ones given when adding
+            them.
+
+        Returns
+        -------
+        coordinates, moments : 2D arrays
+            Easting, northing, upward coordinates and the x, y, z moments of
+            the dipoles, both with shape ``(3, n)``.
+        """
+        if directions is None:
+            directions = [part[4] for part in self.parts]
+        sizes = [part[1] for part in self.parts]
+        offsets = np.concatenate([[0], np.cumsum(sizes, dtype=int)])
+        coordinates = np.empty((3, offsets[-1]))
+        moments = np.empty((3, offsets[-1]))
+        # Unit vectors of all parts at once. Scaling them is the same
+        # operation as angles_to_vector with an amplitude array.
+        inclination, declination = np.reshape(directions, (-1, 2)).T
+        units = eqs.angles_to_vector(inclination, declination, np.ones(len(sizes)))
+        for (kind, size, args, magnitude, _), unit, start, end in zip(
+            self.parts, units.T, offsets[:-1], offsets[1:],
+        ):
+            np.multiply(unit[:, np.newaxis], magnitude, out=moments[:, start:end])
+            if kind == "profile":
+                _fill_profile(coordinates[:, start:end], *args)
+                continue
+            if kind == "grid":
+                region, shape, height = args
+                coords = vd.grid_coordinates(region, shape=shape, extra_coords=height)
+            elif kind == "scatter":
+                region, random_state, height = args
+                coords = vd.scatter_points(
+                    region, size, random_state=random_state, extra_coords=height,
+                )
+            else:
+                coords = args
+            for row, c in zip(coordinates[:, start:end], coords):
+                row[:] = np.ravel(c)
+        return coordinates, moments
+
+
+def _fill_profile(out, first, last, height):
+    """
+    Write the points of verde.profile_coordinates into the (3, size) out array
+    """
+    diffs = [i - j for i, j in zip(last, first)]
+    angle = np.arctan2(*reversed(diffs))
+    distances = np.linspace(0, np.hypot(*diffs), out.shape[1])
+    np.multiply(distances, np.cos(angle), out=out[0])
+    out[0] += first[0]
+    np.multiply(distances, np.sin(angle), out=out[1])
+    out[1] += first[1]
+    out[2] = height
+
+
+def add_source(builder, source, height, magnitude, profiles, grid=None):
     if grid:
         grid_shape, grid_magnitude, region = grid
-        grid_size = grid_shape[0] * grid_shape[1]
-        coordinates.append([np.asarray(c).ravel() for c in vd.grid_coordinates(region, shape=grid_shape, extra_coords=height)])
-        dipole_moments.append(np.array(hm.magnetic_angles_to_vec(np.full(grid_size, grid_magnitude), source[0], source[1])))
-    
+        builder.grid(region, grid_shape, height, grid_magnitude, source)
     for first, last, size in profiles:
-        coords, moments = generate_profile(first, last, size, height, magnitude, source)
-        coordinates.append(coords)
-        dipole_moments.append(moments)
-    return coordinates, dipole_moments
+        builder.profile(first, last, size, height, magnitude, source)
+
+
+def add_dipoles(builder, coords, magnitude, direction):
+    builder.points(np.concatenate(coords, axis=1), magnitude, direction)
 
-def generate_dipoles(coords, magnitude, direction, coordinates, dipole_moments):
-    for coord in coords:
-        coordinates.append(coord)
-        _dipole_moment_e, _dipole_moment_n, _dipole_moment_u = hm.magnetic_angles_to_vec(magnitude, direction[0], direction[1])
-        dipole_moments.append(np.array([[_dipole_moment_e], [_dipole_moment_n], [_dipole_moment_u]]))
+
+def add_icegrav_regional(builder, regional):
+    region = [1.85e6,2.35e6,2.54e6,3.1e6]
+    easting, northing = vd.grid_coordinates(region, shape=(30,30))
+    upward = vd.synthetic.CheckerBoard(region=region, amplitude=15e3, w_east=0.25e6, w_north=0.25e6).predict((easting, northing)) + -60e3
+    regional_coords = (easting, northing, upward)
+    for i, c in enumerate(regional_coords):
+        eqs.contaminate(c, standard_deviation=5, random_state=i)
+    builder.points(regional_coords, 5e12, regional)
 
 def icegrav_synthetic(source1, source2, source3, source4, dyke1, dyke2, dipoles, regional_dipole, regional):
     """
@@ -100,11 +201,9 @@ def icegrav_synthetic(source1, source2, source3, source4, dyke1, dyke2, dipoles,
             ((2.195e6, 2.78e6), (2.265e6, 2.98e6), 900),
         ]),
     ]
-    coordinates, dipole_moments = [], []
+    builder = SourceBuilder()
     for source in sources:
-        coords, moments = generate_source(*source)
-        coordinates.extend(coords)
-        dipole_moments.extend(moments)
+        add_source(builder, *source)
     
     small_dipole_height = -500
     small_dipole_moment = 5e10
@@ -114,7 +213,7 @@ def icegrav_synthetic(source1, source2, source3, source4, dyke1, dyke2, dipoles,
         [[2.11e6], [2.955e6], [small_dipole_height]],
         [[2.15e6], [2.75e6], [small_dipole_height]],
     ]
-    generate_dipoles(small_dipole_coords, small_dipole_moment, dipoles, coordinates, dipole_moments)
+    add_dipoles(builder, small_dipole_coords, small_dipole_moment, dipoles)
     
     regional_dipole_height = -70e3
     regional_dipole_moment = 2e13
@@ -154,21 +253,11 @@ def icegrav_synthetic(source1, source2, source3, source4, dyke1, dyke2, dipoles,
         [[2035e3], [2820e3], [regional_dipole_height]],
         [[2050e3], [2820e3], [regional_dipole_height]],   
     ]
-    generate_dipoles(regional_dipole_coords, regional_dipole_moment, regional_dipole, coordinates, dipole_moments)
+    add_dipoles(builder, regional_dipole_coords, regional_dipole_moment, regional_dipole)
     
     # Regional field
-    region = [1.85e6,2.35e6,2.54e6,3.1e6]
-    easting, northing = vd.grid_coordinates(region, shape=(30,30))
-    upward = vd.synthetic.CheckerBoard(region=region, amplitude=15e3, w_east=0.25e6, w_north=0.25e6).predict((easting, northing)) + -60e3
-    regional_coords = (easting, northing, upward)
-    for i, c in enumerate(regional_coords):
-        eqs.contaminate(c, standard_deviation=5, random_state=i)
-    coordinates.append([np.asarray(c).ravel() for c in regional_coords])
-    dipole_moments.append(np.array(hm.magnetic_angles_to_vec(np.full(900,5e12), regional[0], regional[1])))
-    
-    coordinates = np.concatenate(coordinates, axis=1)
-    dipole_moments = np.concatenate(dipole_moments, axis=1)
-    return coordinates, dipole_moments
+    add_icegrav_regional(builder, regional)
+    return builder.build()
 
 def truncated_regional_synthetic(source1, source2, source3, source4, dyke1, dyke2, dipoles, regional):
     """
@@ -239,11 +328,9 @@ def truncated_regional_synthetic(source1, source2, source3, source4, dyke1, dyke
             ((2.195e6, 2.78e6), (2.265e6, 2.98e6), 900),
         ]),
     ]
-    coordinates, dipole_moments = [], []
+    builder = SourceBuilder()
     for source in sources:
-        coords, moments = generate_source(*source)
-        coordinates.extend(coords)
-        dipole_moments.extend(moments)
+        add_source(builder, *source)
     
     small_dipole_height = -500
     small_dipole_moment = 5e10
@@ -253,21 +340,11 @@ def truncated_regional_synthetic(source1, source2, source3, source4, dyke1, dyke
         [[2.11e6], [2.955e6], [small_dipole_height]],
         [[2.15e6], [2.75e6], [small_dipole_height]],
     ]
-    generate_dipoles(small_dipole_coords, small_dipole_moment, dipoles, coordinates, dipole_moments)
+    add_dipoles(builder, small_dipole_coords, small_dipole_moment, dipoles)
     
     # Regional field
-    region = [1.85e6,2.35e6,2.54e6,3.1e6]
-    easting, northing = vd.grid_coordinates(region, shape=(30,30))
-    upward = vd.synthetic.CheckerBoard(region=region, amplitude=15e3, w_east=0.25e6, w_north=0.25e6).predict((easting, northing)) + -60e3
-    regional_coords = (easting, northing, upward)
-    for i, c in enumerate(regional_coords):
-        eqs.contaminate(c, standard_deviation=5, random_state=i)
-    coordinates.append([np.asarray(c).ravel() for c in regional_coords])
-    dipole_moments.append(np.array(hm.magnetic_angles_to_vec(np.full(900,5e12), regional[0], regional[1])))
-    
-    coordinates = np.concatenate(coordinates, axis=1)
-    dipole_moments = np.concatenate(dipole_moments, axis=1)
-    return coordinates, dipole_moments
+    add_icegrav_regional(builder, regional)
+    return builder.build()
 
 
 def simple_synthetic(dyke1, dyke2, point1, point2, point3, point4, regional ):
@@ -275,194 +352,116 @@ def simple_synthetic(dyke1, dyke2, point1, point2, point3, point4, regional ):
     Simple synthetic dataset associated with the Victoria Land coordinates.
     Provide source directions specifed as [inclination, declination]. E.g. dyke1=[70,60], where inclination=70 and declination=60.
     """
-    dipole_moments = []
-    coordinates = []
+    builder = SourceBuilder()
     dyke_moment_magnitude = 10e7
     # dyke NE-SW
-    coordinates.append(vd.profile_coordinates((-20e3, -5e3), (20e3, 12e3), size=1000, extra_coords=0)[0])
-    dipole_moments.append(eqs.angles_to_vector(dyke1[0], dyke1[1], np.full(1000, dyke_moment_magnitude)))
+    builder.profile((-20e3, -5e3), (20e3, 12e3), 1000, 0, dyke_moment_magnitude, dyke1)
     # dyke NW-SE
-    coordinates.append(vd.profile_coordinates((20e3, -10e3), (-20e3, 25e3), size=1000, extra_coords=0)[0])
-    dipole_moments.append(eqs.angles_to_vector(dyke2[0], dyke2[1], np.full(1000, dyke_moment_magnitude)))
+    builder.profile((20e3, -10e3), (-20e3, 25e3), 1000, 0, dyke_moment_magnitude, dyke2)
     # dyke small
-    coordinates.append(vd.profile_coordinates((20e3, -4e3), (4e3, 3e3), size=1000, extra_coords=0)[0])
-    dipole_moments.append(eqs.angles_to_vector(dyke2[0], dyke2[1], np.full(1000, dyke_moment_magnitude)))
+    builder.profile((20e3, -4e3), (4e3, 3e3), 1000, 0, dyke_moment_magnitude, dyke2)
     # dyke very small
-    coordinates.append(vd.profile_coordinates((3e3, 3.5e3), (-0.5e3, 5.5e3), size=100, extra_coords=0)[0])
-    dipole_moments.append(eqs.angles_to_vector(dyke2[0], dyke2[1], np.full(100, dyke_moment_magnitude)))
+    builder.profile((3e3, 3.5e3), (-0.5e3, 5.5e3), 100, 0, dyke_moment_magnitude, dyke2)
     # point source top left
-    coordinates.append([[-7500], [7000], [-350]])
-    dipole_moments.append(eqs.angles_to_vector(point1[0], point1[1], 6e9))
+    builder.points([[-7500], [7000], [-350]], 6e9, point1)
     # point source centre
-    coordinates.append([[0], [-100], [-1e3]])
-    dipole_moments.append(eqs.angles_to_vector(point2[0], point2[1], 6e9))
+    builder.points([[0], [-100], [-1e3]], 6e9, point2)
     # point source bottom left
-    coordinates.append([[-8000], [-6000], [-800]])
-    dipole_moments.append(eqs.angles_to_vector(point3[0], point3[1], 8e9))
+    builder.points([[-8000], [-6000], [-800]], 8e9, point3)
     # point source bottom right
-    coordinates.append([[7500], [-7500], [-500]])
-    dipole_moments.append(eqs.angles_to_vector(point4[0], point4[1], 6e10))    
+    builder.points([[7500], [-7500], [-500]], 6e10, point4)
     # regional
-    coordinates.append([[2e3, -5e3], [-9e3, 5e3], [-8e3, -8e3]])
-    dipole_moments.append(eqs.angles_to_vector(regional[0], regional[1], np.full(2, 1e13)))
-    
-
-    coordinates = np.concatenate(coordinates, axis=1)
-    dipole_moments = np.concatenate(dipole_moments, axis=1)
-    return coordinates, dipole_moments
+    builder.points([[2e3, -5e3], [-9e3, 5e3], [-8e3, -8e3]], 1e13, regional)
+    return builder.build()
 
 def complicated_synthetic(largest_anomaly, grid_anomaly, scatter_anomaly, north_anomaly, south_anomaly, regional):
     """
     Complicated synthetic dataset associated with the Victoria Land coordinates.
     Provide source directions specifed as [inclination, declination]. E.g. dyke1=[70,60], where inclination=70 and declination=60.
     """
-    dipole_moments = []
-    coordinates = []
+    builder = SourceBuilder()
     # Largest source
     # Part 1
-    coordinates.append(vd.profile_coordinates((260e3,-8.245e6),(310e3,-8.265e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((260e3,-8.25e6),(310e3,-8.27e6), size=2000, extra_coords=-23)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((260e3,-8.255e6),(310e3,-8.275e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((260e3,-8.26e6),(310e3,-8.28e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((260e3,-8.265e6),(310e3,-8.285e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((260e3,-8.27e6),(310e3,-8.29e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((260e3,-8.275e6),(310e3,-8.295e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((270e3,-8.26e6),(310e3,-8.275e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((275e3,-8.26e6),(310e3,-8.28e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((280e3,-8.27e6),(310e3,-8.285e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((280e3,-8.29e6),(325e3,-8.3e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
+    builder.profile((260e3, -8.245e6), (310e3, -8.265e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((260e3, -8.25e6), (310e3, -8.27e6), 2000, -23, 5e8, largest_anomaly)
+    builder.profile((260e3, -8.255e6), (310e3, -8.275e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((260e3, -8.26e6), (310e3, -8.28e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((260e3, -8.265e6), (310e3, -8.285e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((260e3, -8.27e6), (310e3, -8.29e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((260e3, -8.275e6), (310e3, -8.295e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((270e3, -8.26e6), (310e3, -8.275e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((275e3, -8.26e6), (310e3, -8.28e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((280e3, -8.27e6), (310e3, -8.285e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((280e3, -8.29e6), (325e3, -8.3e6), 2000, -5e3, 5e8, largest_anomaly)
     # Part 2
-    coordinates.append(vd.profile_coordinates((285e3,-8.29e6),(380e3,-8.320e6), size=2000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(2000, 5e8)))
-    coordinates.append(vd.profile_coordinates((285e3,-8.295e6),(380e3,-8.325e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
+    builder.profile((285e3, -8.29e6), (380e3, -8.320e6), 2000, -5e3, 5e8, largest_anomaly)
+    builder.profile((285e3, -8.295e6), (380e3, -8.325e6), 4000, -5e3, 5e8, largest_anomaly)
     # Part 3
-    coordinates.append(vd.profile_coordinates((310e3,-8.31e6),(380e3,-8.33e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
-    coordinates.append(vd.profile_coordinates((310e3,-8.315e6),(380e3,-8.335e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))   
-    coordinates.append(vd.profile_coordinates((300e3,-8.315e6),(380e3,-8.34e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
-    coordinates.append(vd.profile_coordinates((290e3,-8.32e6),(395e3,-8.345e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
-    coordinates.append(vd.profile_coordinates((290e3,-8.325e6),(400e3,-8.35e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
-    coordinates.append(vd.profile_coordinates((290e3,-8.33e6),(395e3,-8.355e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
+    builder.profile((310e3, -8.31e6), (380e3, -8.33e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((310e3, -8.315e6), (380e3, -8.335e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((300e3, -8.315e6), (380e3, -8.34e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((290e3, -8.32e6), (395e3, -8.345e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((290e3, -8.325e6), (400e3, -8.35e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((290e3, -8.33e6), (395e3, -8.355e6), 4000, -5e3, 5e8, largest_anomaly)
     # Part 4
-    coordinates.append(vd.profile_coordinates((345e3,-8.35e6),(395e3,-8.36e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
-    coordinates.append(vd.profile_coordinates((345e3,-8.355e6),(395e3,-8.365e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
-    coordinates.append(vd.profile_coordinates((345e3,-8.36e6),(395e3,-8.37e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
-    coordinates.append(vd.profile_coordinates((340e3,-8.36e6),(400e3,-8.375e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
-    coordinates.append(vd.profile_coordinates((345e3,-8.365e6),(400e3,-8.38e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 5e8)))
+    builder.profile((345e3, -8.35e6), (395e3, -8.36e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((345e3, -8.355e6), (395e3, -8.365e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((345e3, -8.36e6), (395e3, -8.37e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((340e3, -8.36e6), (400e3, -8.375e6), 4000, -5e3, 5e8, largest_anomaly)
+    builder.profile((345e3, -8.365e6), (400e3, -8.38e6), 4000, -5e3, 5e8, largest_anomaly)
     # Part 5
-    coordinates.append(vd.profile_coordinates((360e3,-8.37e6),(400e3,-8.385e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((365e3,-8.38e6),(400e3,-8.39e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((370e3,-8.385e6),(405e3,-8.395e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((375e3,-8.39e6),(405e3,-8.40e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((375e3,-8.395e6),(410e3,-8.405e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
+    builder.profile((360e3, -8.37e6), (400e3, -8.385e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((365e3, -8.38e6), (400e3, -8.39e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((370e3, -8.385e6), (405e3, -8.395e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((375e3, -8.39e6), (405e3, -8.40e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((375e3, -8.395e6), (410e3, -8.405e6), 4000, -5e3, 2e8, largest_anomaly)
     # Part 6
-    coordinates.append(vd.profile_coordinates((370e3,-8.40e6),(410e3,-8.41e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((370e3,-8.405e6),(415e3,-8.415e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((370e3,-8.41e6),(415e3,-8.42e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((370e3,-8.415e6),(420e3,-8.425e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
+    builder.profile((370e3, -8.40e6), (410e3, -8.41e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((370e3, -8.405e6), (415e3, -8.415e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((370e3, -8.41e6), (415e3, -8.42e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((370e3, -8.415e6), (420e3, -8.425e6), 4000, -5e3, 2e8, largest_anomaly)
     # Part 7
-    coordinates.append(vd.profile_coordinates((390e3,-8.42e6),(420e3,-8.43e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(85, 75, np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((395e3,-8.425e6),(425e3,-8.435e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((395e3,-8.43e6),(425e3,-8.44e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 2e8)))
-    coordinates.append(vd.profile_coordinates((395e3,-8.435e6),(430e3,-8.445e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 1e8)))
+    builder.profile((390e3, -8.42e6), (420e3, -8.43e6), 4000, -5e3, 2e8, (85, 75))
+    builder.profile((395e3, -8.425e6), (425e3, -8.435e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((395e3, -8.43e6), (425e3, -8.44e6), 4000, -5e3, 2e8, largest_anomaly)
+    builder.profile((395e3, -8.435e6), (430e3, -8.445e6), 4000, -5e3, 1e8, largest_anomaly)
     # Part 8
-    coordinates.append(vd.profile_coordinates((400e3,-8.44e6),(440e3,-8.45e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 9e7)))
-    coordinates.append(vd.profile_coordinates((405e3,-8.445e6),(435e3,-8.455e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 9e7)))
-    coordinates.append(vd.profile_coordinates((415e3,-8.45e6),(430e3,-8.46e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 9e7)))
-    coordinates.append(vd.profile_coordinates((418e3,-8.455e6),(425e3,-8.465e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 9e7)))
-    coordinates.append(vd.profile_coordinates((419e3,-8.46e6),(422e3,-8.47e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 9e7)))
-    coordinates.append(vd.profile_coordinates((420e3,-8.46e6),(422e3,-8.47e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 9e7)))
-    coordinates.append(vd.profile_coordinates((420e3,-8.465e6),(420e3,-8.475e6), size=4000, extra_coords=-5e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(largest_anomaly[0], largest_anomaly[1], np.full(4000, 9e7)))
+    builder.profile((400e3, -8.44e6), (440e3, -8.45e6), 4000, -5e3, 9e7, largest_anomaly)
+    builder.profile((405e3, -8.445e6), (435e3, -8.455e6), 4000, -5e3, 9e7, largest_anomaly)
+    builder.profile((415e3, -8.45e6), (430e3, -8.46e6), 4000, -5e3, 9e7, largest_anomaly)
+    builder.profile((418e3, -8.455e6), (425e3, -8.465e6), 4000, -5e3, 9e7, largest_anomaly)
+    builder.profile((419e3, -8.46e6), (422e3, -8.47e6), 4000, -5e3, 9e7, largest_anomaly)
+    builder.profile((420e3, -8.46e6), (422e3, -8.47e6), 4000, -5e3, 9e7, largest_anomaly)
+    builder.profile((420e3, -8.465e6), (420e3, -8.475e6), 4000, -5e3, 9e7, largest_anomaly)
 
     # North Anomalies
-    coordinates.append([np.asarray(c).ravel() for c in vd.grid_coordinates([340e3,390e3,-8.26e6,-8.20e6,], shape=(100,100), extra_coords=-200)])
-    dipole_moments.append(eqs.angles_to_vector(north_anomaly[0], north_anomaly[1], np.full(10000, 5e8)))
-    coordinates.append(vd.scatter_points([250e3, 430e3, -8.28e6, -8.20e6,], size=1000, random_state=0, extra_coords=-1e3))
-    dipole_moments.append(eqs.angles_to_vector(north_anomaly[0]-10, north_anomaly[1]-10, np.full(1000, 1e10)))
-    coordinates.append([np.asarray(c).ravel() for c in vd.grid_coordinates([420e3,430e3,-8.315e6,-8.30e6,], shape=(50,50), extra_coords=-200)])
-    dipole_moments.append(eqs.angles_to_vector(north_anomaly[0], north_anomaly[1], np.full(2500, 9e8)))
+    builder.grid([340e3, 390e3, -8.26e6, -8.20e6], (100, 100), -200, 5e8, north_anomaly)
+    builder.scatter([250e3, 430e3, -8.28e6, -8.20e6], 1000, -1e3, 1e10, (north_anomaly[0] - 10, north_anomaly[1] - 10), random_state=0)
+    builder.grid([420e3, 430e3, -8.315e6, -8.30e6], (50, 50), -200, 9e8, north_anomaly)
 
     # West scatter anomalies
-    coordinates.append(vd.scatter_points([250e3, 290e3, -8.34e6, -8.30e6,], size=200, random_state=10,extra_coords=-100))
-    dipole_moments.append(eqs.angles_to_vector(scatter_anomaly[0]+10, scatter_anomaly[1]+15, np.full(200, 5e9)))
+    builder.scatter([250e3, 290e3, -8.34e6, -8.30e6], 200, -100, 5e9, (scatter_anomaly[0] + 10, scatter_anomaly[1] + 15), random_state=10)
 
     # Grid anomaly 1
-    coordinates.append([np.asarray(c).ravel() for c in vd.grid_coordinates([248e3,270e3,-8.38e6,-8.36e6,], shape=(50,50), extra_coords=-200)])
-    dipole_moments.append(eqs.angles_to_vector(grid_anomaly[0], grid_anomaly[1], np.full(2500, 9e8)))
+    builder.grid([248e3, 270e3, -8.38e6, -8.36e6], (50, 50), -200, 9e8, grid_anomaly)
     # Grid anomaly 2
-    coordinates.append([np.asarray(c).ravel() for c in vd.grid_coordinates([290e3,310e3,-8.38e6,-8.36e6,], shape=(50,50), extra_coords=-200)])
-    dipole_moments.append(eqs.angles_to_vector(grid_anomaly[0], grid_anomaly[1], np.full(2500, 9e8)))
+    builder.grid([290e3, 310e3, -8.38e6, -8.36e6], (50, 50), -200, 9e8, grid_anomaly)
     # Grid anomaly 3
-    coordinates.append([np.asarray(c).ravel() for c in vd.grid_coordinates([330e3,350e3,-8.40e6,-8.38e6,], shape=(50,50), extra_coords=-200)])
-    dipole_moments.append(eqs.angles_to_vector(grid_anomaly[0], grid_anomaly[1], np.full(2500, 9e8)))
+    builder.grid([330e3, 350e3, -8.40e6, -8.38e6], (50, 50), -200, 9e8, grid_anomaly)
 
     # Middle scatter anomaly
-    coordinates.append(vd.scatter_points([240e3, 260e3, -8.42e6, -8.38e6,], size=250, random_state=1,extra_coords=-100))
-    dipole_moments.append(eqs.angles_to_vector(scatter_anomaly[0], scatter_anomaly[1], np.full(250, 3e9)))
-    coordinates.append(vd.scatter_points([310e3, 400e3, -8.46e6, -8.41e6,], size=1000, random_state=2,extra_coords=-100))
-    dipole_moments.append(eqs.angles_to_vector(scatter_anomaly[0], scatter_anomaly[1], np.full(1000, 5e9)))
+    builder.scatter([240e3, 260e3, -8.42e6, -8.38e6], 250, -100, 3e9, scatter_anomaly, random_state=1)
+    builder.scatter([310e3, 400e3, -8.46e6, -8.41e6], 1000, -100, 5e9, scatter_anomaly, random_state=2)
 
     # South-West anomalies
-    coordinates.append([np.asarray(c).ravel() for c in vd.grid_coordinates([270e3,300e3,-8.47e6,-8.45e6,], shape=(50,50), extra_coords=-200)])
-    dipole_moments.append(eqs.angles_to_vector(south_anomaly[0], south_anomaly[1], np.full(2500, 2e9)))
-    coordinates.append(vd.profile_coordinates((260e3,-8.54e6),(300e3,-8.48e6), size=1000, extra_coords=-6e3)[0])
-    dipole_moments.append(eqs.angles_to_vector(south_anomaly[0]+15, south_anomaly[1]+5, np.full(1000, 5e9)))
-    coordinates.append(vd.scatter_points([250e3, 275e3, -8.50e6, -8.485e6,], size=750, random_state=1,extra_coords=-1e3))
-    dipole_moments.append(eqs.angles_to_vector(south_anomaly[0]-15, south_anomaly[1]-10, np.full(750, 1e9)))
+    builder.grid([270e3, 300e3, -8.47e6, -8.45e6], (50, 50), -200, 2e9, south_anomaly)
+    builder.profile((260e3, -8.54e6), (300e3, -8.48e6), 1000, -6e3, 5e9, (south_anomaly[0] + 15, south_anomaly[1] + 5))
+    builder.scatter([250e3, 275e3, -8.50e6, -8.485e6], 750, -1e3, 1e9, (south_anomaly[0] - 15, south_anomaly[1] - 10), random_state=1)
     # South-East Anomalies
-    coordinates.append(vd.profile_coordinates((370e3,-8.53e6),(400e3,-8.49e6), size=1000, extra_coords=-300)[0])
-    dipole_moments.append(eqs.angles_to_vector(south_anomaly[0]-20, south_anomaly[1]-15, np.full(1000, 8e8)))
-    coordinates.append(vd.profile_coordinates((370e3,-8.53e6),(385e3,-8.49e6), size=1000, extra_coords=-300)[0])
-    dipole_moments.append(eqs.angles_to_vector(south_anomaly[0]+5, south_anomaly[1]+5, np.full(1000, 8e8)))
-    coordinates.append(vd.scatter_points([355e3, 410e3, -8.55e6, -8.50e6,], size=500, random_state=1,extra_coords=-1e3))
-    dipole_moments.append(eqs.angles_to_vector(south_anomaly[0], south_anomaly[1], np.full(500, 5e9)))
+    builder.profile((370e3, -8.53e6), (400e3, -8.49e6), 1000, -300, 8e8, (south_anomaly[0] - 20, south_anomaly[1] - 15))
+    builder.profile((370e3, -8.53e6), (385e3, -8.49e6), 1000, -300, 8e8, (south_anomaly[0] + 5, south_anomaly[1] + 5))
+    builder.scatter([355e3, 410e3, -8.55e6, -8.50e6], 500, -1e3, 5e9, south_anomaly, random_state=1)
 
     # Regional
-    coordinates.append([np.asarray(c).ravel() for c in vd.grid_coordinates([200e3,500e3,-8.6e6,-8.2e6,], shape=(70,70), extra_coords=-30e3)])
-    dipole_moments.append(eqs.angles_to_vector(regional[0], regional[1], np.full(4900, 1e11)))
-
-    coordinates = np.concatenate(coordinates, axis=1)
-    dipole_moments = np.concatenate(dipole_moments, axis=1)
-    return coordinates, dipole_moments
\ No newline at end of file
+    builder.grid([200e3, 500e3, -8.6e6, -8.2e6], (70, 70), -30e3, 1e11, regional)
+    return builder.build()
\ No newline at end of file
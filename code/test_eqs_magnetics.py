@@ -0,0 +1,278 @@
+"""
+Checks of the equivalent-source implementation against reference results.
+
+Run from this folder with ``python -m pytest test_eqs_magnetics.py``.
+"""
+import numpy as np
+import pytest
+import verde as vd
+import verde.base as vdb
+
+import eqs_magnetics as eqs
+import synthetics
+
+
+@pytest.mark.parametrize("size", ["width", 3e3, 2.5e3])
+def test_rolling_window_index_matches_verde(size):
+    "Same windows as verde.rolling_window, including a region-wide window"
+    coordinates = tuple(
+        np.round(c) for c in vd.scatter_points([0, 10e3, 0, 20e3], 4000, random_state=1)
+    )
+    region = vd.get_region(coordinates)
+    if size == "width":
+        size = region[1] - region[0]
+    index = eqs.rolling_window_index(coordinates, size)
+    _, windows = vd.rolling_window(coordinates, size=size, spacing=size / 2)
+    windows = windows.ravel()
+    assert len(index) == windows.size
+    for i, window in enumerate(windows):
+        np.testing.assert_array_equal(index[i], np.sort(window[0]))
+
+
+
+def test_rolling_window_index_region_wide_rounding():
+    "Windows as wide as the region even if rounding swaps the window bounds"
+    coordinates = vd.scatter_points([0, 10e3, 0, 20e3], 100, random_state=0)
+    region = vd.get_region(coordinates)
+    index = eqs.rolling_window_index(coordinates, region[1] - region[0])
+    for i in range(len(index)):
+        # Both easting windows have the same center and all points
+        assert index[i].size == index[i - i % 2].size
+    assert np.unique(np.concatenate([index[i] for i in range(len(index))])).size == 100
+
+
+@pytest.fixture(scope="module")
+def synthetic_data():
+    "Total-field anomaly of the simple synthetic model on scattered points"
+    direction = [70, 60]
+    sources, moments = synthetics.simple_synthetic(*[direction] * 7)
+    coordinates = vd.scatter_points(
+        [-10e3, 10e3, -10e3, 10e3], 1000, random_state=0, extra_coords=500,
+    )
+    field_direction = eqs.angles_to_vector(84, 40, 1)
+    data = eqs.total_field_anomaly(
+        eqs.dipole_magnetic(coordinates, sources, moments), field_direction,
+    )
+    return coordinates, data, field_direction
+
+
+@pytest.mark.parametrize(
+    "estimator",
+    [
+        eqs.EquivalentSourcesMagnetic(damping=1, depth=1e3),
+        eqs.EquivalentSourcesMagneticGB(
+            damping=1, depth=1e3, window_size=5e3, random_state=0,
+        ),
+    ],
+    ids=["dense", "gradient-boosting"],
+)
+@pytest.mark.parametrize("output", ["field", "tfa"])
+@pytest.mark.parametrize("tolerance", [None, 0.3])
+def test_float32_matches_float64(synthetic_data, estimator, output, tolerance):
+    "Fitting and gridding in float32 is within 0.1% of float64"
+    coordinates, data, field_direction = synthetic_data
+    grids = {}
+    for dtype in ["float32", "float64"]:
+        fitted = eqs._with_parameters(estimator, dict(dtype=dtype)).fit(
+            coordinates, data, field_direction,
+        )
+        grids[dtype] = eqs.predict_grid(
+            fitted, [-10e3, 10e3, -10e3, 10e3], shape=(40, 40), height=500,
+            tile_points=500, output=output, field_direction=field_direction,
+            tolerance=tolerance,
+        )
+        prediction = fitted.predict(
+            coordinates, output=output, field_direction=field_direction,
+            tolerance=tolerance,
+        )
+        assert grids[dtype].dtype == dtype
+        assert prediction.dtype == dtype
+    np.testing.assert_allclose(
+        grids["float32"], grids["float64"], rtol=0,
+        atol=1e-3 * np.abs(grids["float64"]).max(),
+    )
+
+
+def test_matrix_free_matches_verde(synthetic_data):
+    "The matrix-free solver gives the same moments as verde's least-squares"
+    coordinates, data, field_direction = synthetic_data
+    coordinates, data = tuple(c[:300] for c in coordinates), data[:300]
+    dipoles = (coordinates[0], coordinates[1], coordinates[2] - 1e3)
+    direction = eqs.angles_to_vector(90, 0, 1)
+    jacobian = eqs.EquivalentSourcesMagnetic().jacobian(
+        coordinates, dipoles, direction, field_direction,
+    )
+    expected = vdb.least_squares(jacobian, data, None, damping=1)
+    moments = eqs.least_squares_matrix_free(
+        coordinates, dipoles, direction, field_direction, data, None, damping=1,
+    )
+    np.testing.assert_allclose(moments, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+    with pytest.warns(UserWarning, match="maximum of 2 iterations"):
+        eqs.least_squares_matrix_free(
+            coordinates, dipoles, direction, field_direction, data, None,
+            max_iterations=2,
+        )
+
+
+def test_dual_layer_prediction_dtype(synthetic_data):
+    "The dual-layer prediction is float32 only if both layers are"
+    coordinates, data, field_direction = synthetic_data
+    deep = eqs.EquivalentSourcesMagnetic(damping=1, depth=3e3, dtype="float32")
+    shallow = eqs.EquivalentSourcesMagneticGB(
+        damping=1, depth=1e3, window_size=5e3, random_state=0, dtype="float32",
+    )
+    layers = eqs.DualLayerEquivalentSources(deep, shallow).fit(
+        coordinates, data, field_direction,
+    )
+    assert layers.predict(coordinates).dtype == "float32"
+    assert layers.predict(coordinates, dtype="float64").dtype == "float64"
+    layers.deep_.dtype = "float64"
+    assert layers.predict(coordinates, output="norm").dtype == "float64"
+
+
+def test_save_load_parameters(synthetic_data, tmp_path):
+    "Data types survive saving and unsaveable parameters warn"
+    coordinates, data, field_direction = synthetic_data
+    estimator = eqs.EquivalentSourcesMagneticGB(
+        damping=1, depth=1e3, window_size=5e3, dtype=np.float32,
+        random_state=np.random.RandomState(0),
+    ).fit(coordinates, data, field_direction)
+    with pytest.warns(UserWarning, match="random_state"):
+        estimator.save(tmp_path)
+    loaded = eqs.load_equivalent_sources(tmp_path)
+    assert np.dtype(loaded.dtype) == np.float32
+    assert loaded.random_state is None
+    assert "windows" not in loaded.fit_stats_
+    np.testing.assert_allclose(
+        loaded.predict(coordinates), estimator.predict(coordinates), rtol=1e-6,
+    )
+
+
+@pytest.mark.parametrize("block", ["line", "narrow"])
+def test_update_small_blocks(synthetic_data, block):
+    "Updating with a single line or a block narrower than the windows"
+    coordinates, data, field_direction = synthetic_data
+    if block == "line":
+        fitted = np.ones(data.size, dtype=bool)
+        new = np.abs(coordinates[1] - 5e3) < 200
+        # Put the points exactly on a line along the easting
+        coordinates = (coordinates[0], np.where(new, 5e3, coordinates[1]), coordinates[2])
+    else:
+        new = coordinates[0] < -5e3
+        fitted = ~new
+    estimator = eqs.EquivalentSourcesMagneticGB(
+        damping=1, depth=1e3, window_size=6e3, random_state=0,
+    ).fit(tuple(c[fitted] for c in coordinates), data[fitted], field_direction)
+    block_coordinates = tuple(c[new] for c in coordinates)
+
+    def misfit():
+        predicted = estimator.predict(
+            block_coordinates, output="tfa", field_direction=field_direction,
+        )
+        return np.sqrt(np.mean((predicted - data[new]) ** 2))
+
+    before = misfit()
+    estimator.update(block_coordinates, data[new], field_direction)
+    assert estimator.window_size_ == 6e3
+    assert estimator.window_plan_["window_size"] <= 6e3
+    assert misfit() < before
+
+
+def test_failed_factorization_spills_to_disk(synthetic_data, tmp_path):
+    "Geometries without a Cholesky factorisation can be cached on disk"
+    coordinates, data, field_direction = synthetic_data
+    cache = eqs.JacobianCache(max_bytes=1, directory=tmp_path)
+    estimator = eqs.EquivalentSourcesMagneticGB(
+        damping=1e-12, depth=1e3, window_size=10e3, dtype="float32", repeat=2,
+        random_state=0, jacobian_cache=cache,
+    ).fit(coordinates, data, field_direction)
+    assert len(list(tmp_path.glob("*.npy"))) > 0
+    assert np.all(np.isfinite(estimator.dipole_moments_))
+
+
+def test_parallel_stats_skipped_windows(synthetic_data):
+    "Window statistics match their windows when some are skipped in a stage"
+    coordinates, data, field_direction = synthetic_data
+    estimator = eqs.EquivalentSourcesMagneticGB(
+        damping=1, depth=1e3, window_size=5e3, influence_radius=2e3, n_jobs=1,
+        noise_level=np.sqrt(np.mean(data**2)) / 4, repeat=3, random_state=0,
+    ).fit(coordinates, data, field_direction)
+    assert sum(estimator.fit_stats_["skipped_windows"]) > 0
+    data_windows = eqs._rolling_windows(
+        coordinates, estimator.dipole_coordinates_, vd.get_region(coordinates),
+        estimator.window_size_,
+    )[2]
+    for stats in estimator.fit_stats_["windows"]:
+        assert stats["n_data"] == data_windows[stats["window"]].size
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_sparse_large_cutoff_matches_dense(synthetic_data, weighted):
+    "A cutoff larger than the region gives the dense solution"
+    coordinates, data, field_direction = synthetic_data
+    coordinates, data = tuple(c[:300] for c in coordinates), data[:300]
+    if weighted:
+        weights = np.random.default_rng(0).uniform(0.5, 2, size=data.size)
+    else:
+        weights = None
+    dense = eqs.EquivalentSourcesMagnetic(damping=1, depth=1e3).fit(
+        coordinates, data, field_direction, weights=weights,
+    )
+    sparse = eqs.EquivalentSourcesMagnetic(
+        damping=1, depth=1e3, solver="sparse", cutoff=1e6,
+    ).fit(coordinates, data, field_direction, weights=weights)
+    np.testing.assert_allclose(
+        sparse.dipole_moments_, dense.dipole_moments_,
+        atol=1e-5 * np.abs(dense.dipole_moments_).max(),
+    )
+
+
+def test_callback_events(synthetic_data):
+    "The window plan is reported before the windows are fitted"
+    coordinates, data, field_direction = synthetic_data
+    events = []
+    estimator = eqs.EquivalentSourcesMagneticGB(
+        damping=1, depth=1e3, window_size=5e3, random_state=0, callback=events.append,
+    ).fit(coordinates, data, field_direction)
+    assert events[0] == {"event": "plan", **estimator.window_plan_}
+    assert {event["event"] for event in events[1:-1]} == {"window", "iteration"}
+    assert events[-1]["event"] == "fit"
+
+
+def test_n_jobs_same_result(synthetic_data):
+    "Solving the windows in parallel doesn't change the result"
+    coordinates, data, field_direction = synthetic_data
+    moments = [
+        eqs.EquivalentSourcesMagneticGB(
+            damping=1, depth=1e3, window_size=5e3, influence_radius=2e3,
+            n_jobs=n_jobs, random_state=0,
+        ).fit(coordinates, data, field_direction).dipole_moments_
+        for n_jobs in [None, 1]
+    ]
+    np.testing.assert_allclose(moments[0], moments[1], rtol=1e-10)
+
+
+def test_cv_score_path_matches_cross_validate(synthetic_data):
+    "The damping path scores are the cross_validate scores"
+    coordinates, data, field_direction = synthetic_data
+    coordinates, data = tuple(c[:300] for c in coordinates), data[:300]
+    estimator = eqs.EquivalentSourcesMagnetic(depth=1e3)
+    dampings = [0.1, 1, 10]
+    scores = estimator.cv_score_path(
+        eqs.PreparedGeometry(coordinates), data, field_direction, dampings,
+    )
+    assert not hasattr(estimator, "dipole_coordinates_")
+    expected = eqs.cross_validate(
+        estimator, coordinates, data, field_direction,
+        [dict(damping=damping) for damping in dampings],
+    ).groupby("parameter_set").score.mean()
+    np.testing.assert_allclose(scores, expected, rtol=1e-10)
+    moments = estimator.fit_path(coordinates, data, field_direction, dampings)
+    assert estimator.depth_ == 1e3
+    estimator.dipole_moments_ = moments[1]
+    fitted = eqs.EquivalentSourcesMagnetic(damping=1, depth=1e3).fit(
+        coordinates, data, field_direction,
+    )
+    np.testing.assert_allclose(
+        estimator.predict(coordinates), fitted.predict(coordinates), rtol=1e-6,
+    )